@@ -0,0 +1,202 @@
+import time
+import tracemalloc
+import uuid
+import random
+from trp import Document, _readingOrder
+import serializer
+
+# Synthetic Textract responses so the benchmarks below run without AWS access.
+# Layout is a grid of text columns with words per line, a few key/value pairs
+# and one table per page, split into result pages like GetDocumentAnalysis.
+
+def _geometry(left, top, width, height):
+    return {
+        "BoundingBox" : { "Width" : width, "Height" : height, "Left" : left, "Top" : top },
+        "Polygon" : [ { "X" : left, "Y" : top }, { "X" : left + width, "Y" : top },
+                      { "X" : left + width, "Y" : top + height }, { "X" : left, "Y" : top + height } ]
+    }
+
+def syntheticResponse(pageCount=10, linesPerPage=100, columns=2, wordsPerLine=8, fieldsPerPage=10, blocksPerResponse=1000, seed=1):
+
+    rnd = random.Random(seed)
+
+    def newId():
+        return str(uuid.UUID(int=rnd.getrandbits(128)))
+
+    blocks = []
+    columnWidth = 1.0 / columns
+    rowsPerColumn = max(1, (linesPerPage + columns - 1) // columns)
+    rowHeight = 0.9 / rowsPerColumn
+
+    for p in range(pageCount):
+        page = { "BlockType" : "PAGE", "Id" : newId(), "Page" : p + 1, "Geometry" : _geometry(0, 0, 1, 1),
+                 "Relationships" : [ { "Type" : "CHILD", "Ids" : [] } ] }
+        pageBlocks = [page]
+
+        for i in range(linesPerPage):
+            column = i // rowsPerColumn
+            left = column * columnWidth + 0.01
+            top = (i % rowsPerColumn) * rowHeight
+            words = []
+            for j in range(wordsPerLine):
+                words.append({ "BlockType" : "WORD", "Id" : newId(), "Page" : p + 1, "Confidence" : 99.1,
+                               "Text" : "word{}".format(j), "TextType" : "PRINTED",
+                               "Geometry" : _geometry(left + j * columnWidth * 0.1, top, columnWidth * 0.09, rowHeight * 0.8) })
+            line = { "BlockType" : "LINE", "Id" : newId(), "Page" : p + 1, "Confidence" : 99.2,
+                     "Text" : " ".join([w["Text"] for w in words]),
+                     "Geometry" : _geometry(left, top, columnWidth * 0.9, rowHeight * 0.8),
+                     "Relationships" : [ { "Type" : "CHILD", "Ids" : [w["Id"] for w in words] } ] }
+            page["Relationships"][0]["Ids"].append(line["Id"])
+            pageBlocks.append(line)
+            pageBlocks.extend(words)
+
+        for k in range(fieldsPerPage):
+            keyWord = { "BlockType" : "WORD", "Id" : newId(), "Page" : p + 1, "Confidence" : 95.0,
+                        "Text" : "Key{}:".format(k), "Geometry" : _geometry(0.1, 0.95, 0.1, 0.01) }
+            valueWord = { "BlockType" : "WORD", "Id" : newId(), "Page" : p + 1, "Confidence" : 95.0,
+                          "Text" : "Value{}".format(k), "Geometry" : _geometry(0.3, 0.95, 0.1, 0.01) }
+            value = { "BlockType" : "KEY_VALUE_SET", "Id" : newId(), "Page" : p + 1, "Confidence" : 90.0,
+                      "EntityTypes" : ["VALUE"], "Geometry" : _geometry(0.3, 0.95, 0.1, 0.01),
+                      "Relationships" : [ { "Type" : "CHILD", "Ids" : [valueWord["Id"]] } ] }
+            key = { "BlockType" : "KEY_VALUE_SET", "Id" : newId(), "Page" : p + 1, "Confidence" : 90.0,
+                    "EntityTypes" : ["KEY"], "Geometry" : _geometry(0.1, 0.95, 0.1, 0.01),
+                    "Relationships" : [ { "Type" : "VALUE", "Ids" : [value["Id"]] },
+                                        { "Type" : "CHILD", "Ids" : [keyWord["Id"]] } ] }
+            pageBlocks.extend([key, value, keyWord, valueWord])
+
+        cells = []
+        cellWords = []
+        for r in range(4):
+            for c in range(4):
+                word = { "BlockType" : "WORD", "Id" : newId(), "Page" : p + 1, "Confidence" : 97.0,
+                         "Text" : "r{}c{}".format(r, c), "Geometry" : _geometry(0.2 * c, 0.5 + 0.02 * r, 0.2, 0.02) }
+                cells.append({ "BlockType" : "CELL", "Id" : newId(), "Page" : p + 1, "Confidence" : 97.0,
+                               "RowIndex" : r + 1, "ColumnIndex" : c + 1, "RowSpan" : 1, "ColumnSpan" : 1,
+                               "Geometry" : _geometry(0.2 * c, 0.5 + 0.02 * r, 0.2, 0.02),
+                               "Relationships" : [ { "Type" : "CHILD", "Ids" : [word["Id"]] } ] })
+                cellWords.append(word)
+        table = { "BlockType" : "TABLE", "Id" : newId(), "Page" : p + 1, "Confidence" : 97.0,
+                  "Geometry" : _geometry(0, 0.5, 0.8, 0.08),
+                  "Relationships" : [ { "Type" : "CHILD", "Ids" : [c["Id"] for c in cells] } ] }
+        pageBlocks.append(table)
+        pageBlocks.extend(cells)
+        pageBlocks.extend(cellWords)
+
+        blocks.extend(pageBlocks)
+
+    responsePages = []
+    for i in range(0, len(blocks), blocksPerResponse):
+        responsePages.append({ "DocumentMetadata" : { "Pages" : pageCount }, "JobStatus" : "SUCCEEDED",
+                               "Blocks" : blocks[i:i + blocksPerResponse] })
+    return responsePages
+
+def benchmarkPageMemory(pageCount=20, linesPerPage=200, wordsPerLine=8):
+
+    response = syntheticResponse(pageCount=pageCount, linesPerPage=linesPerPage, wordsPerLine=wordsPerLine)
+
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    start = time.perf_counter()
+    doc = Document(response)
+    elapsed = time.perf_counter() - start
+    after = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+
+    perPage = (after - before) / len(doc.pages)
+    print("Page memory: {} pages, {} lines/page, {} words/line -> {:.1f} KB/page, parse {:.3f}s".format(
+        len(doc.pages), linesPerPage, wordsPerLine, perPage / 1024, elapsed))
+    return perPage
+
+def _legacyLinesInReadingOrder(page):
+    # Column scan used by Page.getLinesInReadingOrder before the sort-and-sweep engine
+    columns = []
+    lines = []
+    for item in page.lines:
+            column_found=False
+            for index, column in enumerate(columns):
+                bbox_left = item.geometry.boundingBox.left
+                bbox_right = item.geometry.boundingBox.left + item.geometry.boundingBox.width
+                bbox_centre = item.geometry.boundingBox.left + item.geometry.boundingBox.width/2
+                column_centre = column['left'] + column['right']/2
+                if (bbox_centre > column['left'] and bbox_centre < column['right']) or (column_centre > bbox_left and column_centre < bbox_right):
+                    lines.append([index, item.text])
+                    column_found=True
+                    break
+            if not column_found:
+                columns.append({'left':item.geometry.boundingBox.left, 'right':item.geometry.boundingBox.left + item.geometry.boundingBox.width})
+                lines.append([len(columns)-1, item.text])
+
+    lines.sort(key=lambda x: x[0])
+    return lines
+
+def benchmarkReadingOrder(linesPerPage=2000, columns=2, repeat=3):
+
+    response = syntheticResponse(pageCount=1, linesPerPage=linesPerPage, columns=columns, wordsPerLine=1, fieldsPerPage=0)
+    page = Document(response).pages[0]
+
+    start = time.perf_counter()
+    for i in range(repeat):
+        legacy = _legacyLinesInReadingOrder(page)
+    legacyElapsed = (time.perf_counter() - start) / repeat
+
+    start = time.perf_counter()
+    for i in range(repeat):
+        lines = page.getLinesInReadingOrder()
+    elapsed = (time.perf_counter() - start) / repeat
+
+    print("Reading order: {} lines, {} columns -> legacy {:.4f}s ({} columns found), sort-and-sweep {:.4f}s ({} columns found)".format(
+        linesPerPage, columns, legacyElapsed, len(set([l[0] for l in legacy])), elapsed, len(set([l[0] for l in lines]))))
+    return legacyElapsed, elapsed
+
+# Small layouts as (left, width, top) per line, with the reading order expected for them
+READING_ORDER_LAYOUTS = {
+    "single column, short paragraph ending" : (
+        [(0.13, 0.77, 0.1), (0.10, 0.80, 0.2), (0.10, 0.02, 0.3), (0.13, 0.77, 0.4), (0.10, 0.80, 0.5)],
+        [0, 1, 2, 3, 4]),
+    "right aligned date above the body" : (
+        [(0.7, 0.15, 0.05), (0.1, 0.8, 0.1), (0.1, 0.8, 0.2), (0.13, 0.77, 0.3), (0.1, 0.6, 0.4)],
+        [0, 1, 2, 3, 4]),
+    "two columns under a full width header" : (
+        [(0.1, 0.8, 0.0), (0.05, 0.4, 0.1), (0.55, 0.4, 0.1), (0.05, 0.38, 0.2), (0.55, 0.35, 0.2), (0.05, 0.1, 0.3)],
+        [0, 1, 3, 5, 2, 4])
+}
+
+def checkReadingOrderLayouts():
+    failed = []
+    for name, (boxes, expected) in READING_ORDER_LAYOUTS.items():
+        columns, order = _readingOrder([b[0] for b in boxes], [b[1] for b in boxes], [b[2] for b in boxes])
+        if(order != expected):
+            failed.append(name)
+        print("Reading order layout '{}': {}".format(name, "ok" if order == expected else "got {}, expected {}".format(order, expected)))
+    return failed
+
+def benchmarkSerializer(pageCount=1, linesPerPage=60, repeat=50):
+    # Defaults are roughly testdocs/pdfdoc.pdf: one page of dense text with a form and a table
+
+    response = syntheticResponse(pageCount=pageCount, linesPerPage=linesPerPage)
+    results = {}
+
+    for backend in serializer.availableBackends():
+        start = time.perf_counter()
+        for i in range(repeat):
+            encoded = backend.dumpsBytes(response)
+        encodeElapsed = (time.perf_counter() - start) / repeat
+
+        start = time.perf_counter()
+        for i in range(repeat):
+            backend.loads(encoded)
+        decodeElapsed = (time.perf_counter() - start) / repeat
+
+        megabytes = len(encoded) / (1024 * 1024)
+        print("Serializer {}: {} pages, {:.2f} MB -> dumps {:.1f} MB/s, loads {:.1f} MB/s".format(
+            backend.name, pageCount, megabytes, megabytes / encodeElapsed, megabytes / decodeElapsed))
+        results[backend.name] = (encodeElapsed, decodeElapsed)
+    return results
+
+if __name__ == "__main__":
+    benchmarkPageMemory()
+    for columnCount in [2, 8, 32, 128]:
+        benchmarkReadingOrder(linesPerPage=4000, columns=columnCount)
+    checkReadingOrderLayouts()
+    benchmarkSerializer()
+    benchmarkSerializer(pageCount=100, repeat=3)
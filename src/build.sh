@@ -1,6 +1,7 @@
 echo "Copying lambda functions..."
 cp helper.py ../textract-pipeline/lambda/helper/python/helper.py
 cp datastore.py ../textract-pipeline/lambda/helper/python/datastore.py
+cp serializer.py ../textract-pipeline/lambda/helper/python/serializer.py
 cp s3proc.py ../textract-pipeline/lambda/s3processor/lambda_function.py
 cp s3batchproc.py ../textract-pipeline/lambda/s3batchprocessor/lambda_function.py
 cp docproc.py ../textract-pipeline/lambda/documentprocessor/lambda_function.py
@@ -1,14 +1,38 @@
 import boto3
+import threading
+import queue
+import heapq
+import zlib
+from concurrent.futures import ThreadPoolExecutor
 from botocore.exceptions import ClientError
-from helper import AwsHelper
+from boto3.dynamodb.conditions import Attr, Key
+from helper import AwsHelper, RetryHelper, QueueHelper
 import  datetime
+from decimal import Decimal
 
 class DocumentStore:
 
+    # Largest number of actions DynamoDB accepts in one TransactWriteItems call
+    TRANSACTION_SIZE = 100
+
+    # Global secondary index on statusShard and documentCreatedOn, see the CDK
+    # stack. statusShard is documentStatus plus one of STATUS_SHARDS suffixes
+    # picked from the documentId, so writes for one status spread over
+    # several index partitions. Queries fan out over the shards.
+    STATUS_INDEX = 'DocumentStatusIndex'
+    STATUS_SHARDS = 16
+
     def __init__(self, documentsTableName, outputTableName):
         self._documentsTableName = documentsTableName
         self._outputTableName = outputTableName
 
+    @staticmethod
+    def statusShard(documentId, documentStatus, shard=None):
+        # Index key of a document, or of the given shard number
+        if(shard is None):
+            shard = zlib.crc32(documentId.encode('utf-8')) % DocumentStore.STATUS_SHARDS
+        return "{}#{:02d}".format(documentStatus, shard)
+
     def createDocument(self, documentId, bucketName, objectName):
 
         err = None
@@ -19,12 +43,13 @@ class DocumentStore:
         try:
             table.update_item(
                 Key = { "documentId": documentId },
-                UpdateExpression = 'SET bucketName = :bucketNameValue, objectName = :objectNameValue, documentStatus = :documentstatusValue, documentCreatedOn = :documentCreatedOnValue',
+                UpdateExpression = 'SET bucketName = :bucketNameValue, objectName = :objectNameValue, documentStatus = :documentstatusValue, statusShard = :statusShardValue, documentCreatedOn = :documentCreatedOnValue',
                 ConditionExpression = 'attribute_not_exists(documentId)',
                 ExpressionAttributeValues = {
                     ':bucketNameValue': bucketName,
                     ':objectNameValue': objectName,
                     ':documentstatusValue': 'IN_PROGRESS',
+                    ':statusShardValue': DocumentStore.statusShard(documentId, 'IN_PROGRESS'),
                     ':documentCreatedOnValue': str(datetime.datetime.utcnow())
                 }
             )
@@ -48,10 +73,11 @@ class DocumentStore:
         try:
             table.update_item(
                 Key = { 'documentId': documentId },
-                UpdateExpression = 'SET documentStatus= :documentstatusValue',
+                UpdateExpression = 'SET documentStatus= :documentstatusValue, statusShard = :statusShardValue',
                 ConditionExpression = 'attribute_exists(documentId)',
                 ExpressionAttributeValues = {
-                    ':documentstatusValue': documentStatus
+                    ':documentstatusValue': documentStatus,
+                    ':statusShardValue': DocumentStore.statusShard(documentId, documentStatus)
                 }
             )
         except ClientError as e:
@@ -73,10 +99,11 @@ class DocumentStore:
         try:
             table.update_item(
                 Key = { 'documentId': documentId },
-                UpdateExpression = 'SET documentStatus= :documentstatusValue, documentCompletedOn = :documentCompletedOnValue',
+                UpdateExpression = 'SET documentStatus= :documentstatusValue, statusShard = :statusShardValue, documentCompletedOn = :documentCompletedOnValue',
                 ConditionExpression = 'attribute_exists(documentId)',
                 ExpressionAttributeValues = {
                     ':documentstatusValue': "SUCCEEDED",
+                    ':statusShardValue': DocumentStore.statusShard(documentId, "SUCCEEDED"),
                     ':documentCompletedOnValue': str(datetime.datetime.utcnow())
                 }
             )
@@ -89,6 +116,121 @@ class DocumentStore:
 
         return err
 
+    def _transactWrite(self, items, maxRetries=8):
+        # items is a list of (documentId, transactItem, conditionError). Each
+        # chunk of items is written as one transaction. When it is cancelled
+        # the items whose condition failed get their conditionError and the
+        # rest of the chunk is retried; conflicts and throttling are retried
+        # with jittered exponential backoff.
+
+        errors = {}
+
+        dynamodb = AwsHelper().getClient("dynamodb")
+
+        for i in range(0, len(items), DocumentStore.TRANSACTION_SIZE):
+            pending = items[i:i + DocumentStore.TRANSACTION_SIZE]
+            attempt = 0
+            while(pending):
+                try:
+                    dynamodb.transact_write_items(TransactItems=[item for documentId, item, conditionError in pending])
+                    pending = []
+                except ClientError as e:
+                    if e.response['Error']['Code'] != "TransactionCanceledException":
+                        raise
+
+                    reasons = e.response.get('CancellationReasons', [])
+                    retry = []
+                    for k, (documentId, item, conditionError) in enumerate(pending):
+                        code = reasons[k].get('Code', 'None') if k < len(reasons) else 'None'
+                        if(code == "ConditionalCheckFailed"):
+                            print("{}: {}".format(documentId, conditionError['Error']))
+                            errors[documentId] = conditionError
+                        else:
+                            retry.append((documentId, item, conditionError))
+
+                    if(len(retry) == len(pending)):
+                        attempt = attempt + 1
+                        if(attempt > maxRetries):
+                            raise Exception("Transaction for {} documents failed after {} retries: {}".format(
+                                len(pending), maxRetries, [r.get('Code') for r in reasons]))
+                        RetryHelper.backoff(attempt, "Transaction cancelled ({})".format(
+                            ", ".join(sorted(set([r.get('Code', 'None') for r in reasons]) - set(['None'])))))
+                    pending = retry
+
+        return errors
+
+    def _uniqueDocuments(self, documentIds, duplicateError):
+        # A transaction may not touch the same item twice
+        seen = set()
+        unique = []
+        errors = {}
+        for documentId in documentIds:
+            if(documentId in seen):
+                if(duplicateError):
+                    errors[documentId] = duplicateError
+                continue
+            seen.add(documentId)
+            unique.append(documentId)
+        return unique, errors
+
+    def createDocuments(self, documents):
+        # documents is a list of (documentId, bucketName, objectName). Returns
+        # a dict of documentId -> error for documents that were not created.
+
+        documentIds, errors = self._uniqueDocuments([d[0] for d in documents], {'Error' : 'Document already exist.'})
+        documentsById = {}
+        for documentId, bucketName, objectName in documents:
+            documentsById.setdefault(documentId, (bucketName, objectName))
+
+        createdOn = str(datetime.datetime.utcnow())
+        items = []
+        for documentId in documentIds:
+            bucketName, objectName = documentsById[documentId]
+            items.append((documentId, {
+                'Put': {
+                    'TableName': self._documentsTableName,
+                    'Item': {
+                        'documentId': {'S': documentId},
+                        'bucketName': {'S': bucketName},
+                        'objectName': {'S': objectName},
+                        'documentStatus': {'S': 'IN_PROGRESS'},
+                        'statusShard': {'S': DocumentStore.statusShard(documentId, 'IN_PROGRESS')},
+                        'documentCreatedOn': {'S': createdOn}
+                    },
+                    'ConditionExpression': 'attribute_not_exists(documentId)'
+                }
+            }, {'Error' : 'Document already exist.'}))
+
+        errors.update(self._transactWrite(items))
+
+        return errors
+
+    def markDocumentsComplete(self, documentIds):
+        # Returns a dict of documentId -> error for documents that do not exist
+
+        documentIds, errors = self._uniqueDocuments(documentIds, None)
+
+        completedOn = str(datetime.datetime.utcnow())
+        items = []
+        for documentId in documentIds:
+            items.append((documentId, {
+                'Update': {
+                    'TableName': self._documentsTableName,
+                    'Key': {'documentId': {'S': documentId}},
+                    'UpdateExpression': 'SET documentStatus= :documentstatusValue, statusShard = :statusShardValue, documentCompletedOn = :documentCompletedOnValue',
+                    'ConditionExpression': 'attribute_exists(documentId)',
+                    'ExpressionAttributeValues': {
+                        ':documentstatusValue': {'S': 'SUCCEEDED'},
+                        ':statusShardValue': {'S': DocumentStore.statusShard(documentId, 'SUCCEEDED')},
+                        ':documentCompletedOnValue': {'S': completedOn}
+                    }
+                }
+            }, {'Error' : 'Document does not exist.'}))
+
+        errors.update(self._transactWrite(items))
+
+        return errors
+
     def getDocument(self, documentId):
 
         dynamodb = AwsHelper().getClient("dynamodb")
@@ -131,7 +273,7 @@ class DocumentStore:
         else:
             response = table.scan(Limit=pageSize)
 
-        print("response: {}".format(response))
+        print("Scanned {} documents".format(response.get('Count', 0)))
 
         data = []
 
@@ -147,4 +289,362 @@ class DocumentStore:
             print("nexToken: {}".format(nextToken))
             documents["nextToken"] = nextToken
 
-        return documents
\ No newline at end of file
+        return documents
+
+    def _scanSegment(self, segment, totalSegments, scanArgs, results, stop):
+        # Runs on a worker thread, resources are per thread (see AwsHelper.getResource)
+        try:
+            dynamodb = AwsHelper().getResource("dynamodb")
+            table = dynamodb.Table(self._documentsTableName)
+
+            scanArgs = dict(scanArgs, Segment=segment, TotalSegments=totalSegments)
+            while(not stop.is_set()):
+                response = table.scan(**scanArgs)
+                QueueHelper.put(results, stop, ('items', response.get('Items', [])))
+                if('LastEvaluatedKey' not in response):
+                    break
+                scanArgs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+            QueueHelper.put(results, stop, ('done', segment))
+        except Exception as e:
+            QueueHelper.put(results, stop, ('error', e))
+
+    def scanDocuments(self, totalSegments=8, projection=None, documentStatus=None, pageSize=None):
+        # Yields the documents of the DocumentsTable, scanning totalSegments
+        # segments in parallel. Items arrive in no particular order.
+        # projection is a list of attribute names to return, documentStatus a
+        # status or list of statuses filtered server side.
+
+        scanArgs = {}
+        if(projection):
+            names = {}
+            for i, attributeName in enumerate(projection):
+                names["#p{}".format(i)] = attributeName
+            scanArgs['ProjectionExpression'] = ", ".join(names.keys())
+            scanArgs['ExpressionAttributeNames'] = names
+        if(documentStatus):
+            if(isinstance(documentStatus, str)):
+                scanArgs['FilterExpression'] = Attr('documentStatus').eq(documentStatus)
+            else:
+                scanArgs['FilterExpression'] = Attr('documentStatus').is_in(list(documentStatus))
+        if(pageSize):
+            scanArgs['Limit'] = pageSize
+
+        results = queue.Queue(maxsize=totalSegments * 2)
+        stop = threading.Event()
+        executor = ThreadPoolExecutor(max_workers=totalSegments)
+        try:
+            for segment in range(totalSegments):
+                executor.submit(self._scanSegment, segment, totalSegments, scanArgs, results, stop)
+
+            segmentsDone = 0
+            while(segmentsDone < totalSegments):
+                kind, value = results.get()
+                if(kind == 'items'):
+                    for item in value:
+                        yield item
+                elif(kind == 'error'):
+                    raise value
+                else:
+                    segmentsDone = segmentsDone + 1
+        finally:
+            stop.set()
+            executor.shutdown(wait=False)
+
+    def countDocumentsByStatus(self, totalSegments=8):
+        # Returns { documentStatus : count } over the whole DocumentsTable
+
+        counts = {}
+        for item in self.scanDocuments(totalSegments, projection=['documentStatus']):
+            status = item.get('documentStatus', 'UNKNOWN')
+            counts[status] = counts.get(status, 0) + 1
+        return counts
+
+    def backfillStatusShards(self, totalSegments=8):
+        # One-off migration for documents written before statusShard existed:
+        # they are not in the status index until statusShard is set. Only
+        # documents still without one, in the status that was read, are
+        # updated, so concurrent status changes win. Returns the update count.
+
+        dynamodb = AwsHelper().getResource("dynamodb")
+        table = dynamodb.Table(self._documentsTableName)
+
+        updated = 0
+        for item in self.scanDocuments(totalSegments, projection=['documentId', 'documentStatus', 'statusShard']):
+            if('statusShard' in item or 'documentStatus' not in item):
+                continue
+            try:
+                table.update_item(
+                    Key = { 'documentId': item['documentId'] },
+                    UpdateExpression = 'SET statusShard = :statusShardValue',
+                    ConditionExpression = 'attribute_not_exists(statusShard) AND documentStatus = :documentstatusValue',
+                    ExpressionAttributeValues = {
+                        ':statusShardValue': DocumentStore.statusShard(item['documentId'], item['documentStatus']),
+                        ':documentstatusValue': item['documentStatus']
+                    }
+                )
+                updated = updated + 1
+            except ClientError as e:
+                if e.response['Error']['Code'] != "ConditionalCheckFailedException":
+                    raise
+        print("Set statusShard on {} documents.".format(updated))
+        return updated
+
+    def _queryShard(self, table, keyCondition, newestFirst, pageSize):
+        queryArgs = {
+            'IndexName': DocumentStore.STATUS_INDEX,
+            'KeyConditionExpression': keyCondition,
+            'ScanIndexForward': not newestFirst
+        }
+        if(pageSize):
+            queryArgs['Limit'] = pageSize
+
+        while(True):
+            response = table.query(**queryArgs)
+            for item in response.get('Items', []):
+                yield item
+            if('LastEvaluatedKey' not in response):
+                break
+            queryArgs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+    def queryDocumentsByStatus(self, documentStatus, createdFrom=None, createdTo=None, pageSize=None, newestFirst=False):
+        # Yields documents with documentStatus through the status index,
+        # optionally limited to documentCreatedOn between createdFrom and
+        # createdTo (inclusive, datetimes or strings as stored by createDocument).
+        # Every shard is queried and the results merged in documentCreatedOn
+        # order. Items carry the keys, bucketName and objectName.
+
+        dynamodb = AwsHelper().getResource("dynamodb")
+        table = dynamodb.Table(self._documentsTableName)
+
+        createdOn = None
+        if(createdFrom is not None and createdTo is not None):
+            createdOn = Key('documentCreatedOn').between(str(createdFrom), str(createdTo))
+        elif(createdFrom is not None):
+            createdOn = Key('documentCreatedOn').gte(str(createdFrom))
+        elif(createdTo is not None):
+            createdOn = Key('documentCreatedOn').lte(str(createdTo))
+
+        shards = []
+        for shard in range(DocumentStore.STATUS_SHARDS):
+            keyCondition = Key('statusShard').eq(DocumentStore.statusShard(None, documentStatus, shard))
+            if(createdOn is not None):
+                keyCondition = keyCondition & createdOn
+            shards.append(self._queryShard(table, keyCondition, newestFirst, pageSize))
+
+        return heapq.merge(*shards, key=lambda item: item['documentCreatedOn'], reverse=newestFirst)
+
+    def getStuckDocuments(self, olderThan=datetime.timedelta(hours=1), documentStatus='IN_PROGRESS'):
+        # Yields documents that have been in documentStatus since before now - olderThan, oldest first
+        cutoff = datetime.datetime.utcnow() - olderThan
+        return self.queryDocumentsByStatus(documentStatus, createdTo=cutoff)
+
+class ControlStore:
+    # Small pieces of pipeline state that outlive a Lambda invocation, one
+    # item per controlId. Numbers are stored as Decimal and returned as float.
+
+    def __init__(self, controlTableName):
+        self._controlTableName = controlTableName
+
+    def getState(self, controlId):
+
+        dynamodb = AwsHelper().getResource("dynamodb")
+        table = dynamodb.Table(self._controlTableName)
+
+        response = table.get_item(Key={ 'controlId': controlId }, ConsistentRead=True)
+
+        state = None
+        if('Item' in response):
+            state = {}
+            for key, value in response['Item'].items():
+                if(key == 'controlId'):
+                    continue
+                state[key] = float(value) if isinstance(value, Decimal) else value
+
+        return state
+
+    def putState(self, controlId, state):
+
+        dynamodb = AwsHelper().getResource("dynamodb")
+        table = dynamodb.Table(self._controlTableName)
+
+        item = { 'controlId': controlId }
+        for key, value in state.items():
+            if(value is None):
+                continue
+            item[key] = Decimal(str(value)) if isinstance(value, float) else value
+
+        table.put_item(Item=item)
+
+class JobLedger:
+    # Tracks Textract jobs in flight in the control table: a counter item
+    # plus one item per job. A job is counted when its item is created and
+    # released when its item is deleted, each in one transaction with the
+    # counter update, so repeated start or completion notices for the same
+    # job do not change the count. A completion notice that arrives before
+    # the start is recorded leaves a completed marker (an item with
+    # jobCompletedOn), so the late start is not counted.
+
+    COUNTER_ID = 'textract-jobs-in-flight'
+    JOB_PREFIX = 'job#'
+
+    # A late start follows its completion notice within seconds; duplicate
+    # completion notices leave markers too, so they are not kept for long
+    MARKER_MAX_AGE = datetime.timedelta(hours=1)
+
+    def __init__(self, controlTableName, maxRetries=8):
+        self._controlTableName = controlTableName
+        self._maxRetries = maxRetries
+
+    def _counterUpdate(self, delta):
+        return {
+            'Update': {
+                'TableName': self._controlTableName,
+                'Key': {'controlId': {'S': JobLedger.COUNTER_ID}},
+                'UpdateExpression': 'ADD inFlight :delta',
+                'ExpressionAttributeValues': {':delta': {'N': str(delta)}}
+            }
+        }
+
+    def _transactWrite(self, transactItems):
+        # Returns False when the condition on the job item failed. The
+        # counter is a hot item, so transaction conflicts are retried.
+
+        dynamodb = AwsHelper().getClient("dynamodb")
+
+        attempt = 0
+        while(True):
+            try:
+                dynamodb.transact_write_items(TransactItems=transactItems)
+                return True
+            except ClientError as e:
+                if e.response['Error']['Code'] != "TransactionCanceledException":
+                    raise
+                reasons = e.response.get('CancellationReasons', [])
+                if(reasons and reasons[0].get('Code') == "ConditionalCheckFailed"):
+                    return False
+                attempt = attempt + 1
+                if(attempt > self._maxRetries):
+                    raise
+                RetryHelper.backoff(attempt, "Job ledger transaction cancelled", maxDelay=2)
+
+    def recordJobStarted(self, documentId, jobId):
+        # A completed marker left by an earlier job of the document is replaced
+        started = self._transactWrite([
+            {
+                'Put': {
+                    'TableName': self._controlTableName,
+                    'Item': {
+                        'controlId': {'S': JobLedger.JOB_PREFIX + documentId},
+                        'jobId': {'S': jobId},
+                        'jobStartedOn': {'S': str(datetime.datetime.utcnow())}
+                    },
+                    'ConditionExpression': 'attribute_not_exists(controlId) OR (attribute_exists(jobCompletedOn) AND jobId <> :jobIdValue)',
+                    'ExpressionAttributeValues': {':jobIdValue': {'S': jobId}}
+                }
+            },
+            self._counterUpdate(1)
+        ])
+        if(not started):
+            # Already recorded, or already completed: then drop its marker
+            self._deleteCompletedMarker(documentId, jobId)
+        return started
+
+    def recordJobCompleted(self, documentId, jobId=None):
+        # Returns True if a slot was released
+        delete = {
+            'TableName': self._controlTableName,
+            'Key': {'controlId': {'S': JobLedger.JOB_PREFIX + documentId}},
+            'ConditionExpression': 'attribute_exists(jobStartedOn)'
+        }
+        if(jobId):
+            delete['ConditionExpression'] = 'attribute_exists(jobStartedOn) AND jobId = :jobIdValue'
+            delete['ExpressionAttributeValues'] = {':jobIdValue': {'S': jobId}}
+
+        for attempt in range(3):
+            if(self._transactWrite([{ 'Delete': delete }, self._counterUpdate(-1)])):
+                return True
+            # The start is not recorded (yet). The marker only goes in while
+            # there is no item, otherwise the start just landed: try again.
+            if(self._putCompletedMarker(documentId, jobId)):
+                break
+        return False
+
+    def _putCompletedMarker(self, documentId, jobId):
+
+        dynamodb = AwsHelper().getResource("dynamodb")
+        table = dynamodb.Table(self._controlTableName)
+
+        item = { 'controlId': JobLedger.JOB_PREFIX + documentId, 'jobCompletedOn': str(datetime.datetime.utcnow()) }
+        if(jobId):
+            item['jobId'] = jobId
+
+        try:
+            table.put_item(Item=item, ConditionExpression='attribute_not_exists(controlId) OR attribute_exists(jobCompletedOn)')
+            return True
+        except ClientError as e:
+            if e.response['Error']['Code'] == "ConditionalCheckFailedException":
+                return False
+            raise
+
+    def _deleteCompletedMarker(self, documentId, jobId=None):
+
+        dynamodb = AwsHelper().getResource("dynamodb")
+        table = dynamodb.Table(self._controlTableName)
+
+        deleteArgs = {
+            'Key': { 'controlId': JobLedger.JOB_PREFIX + documentId },
+            'ConditionExpression': 'attribute_exists(jobCompletedOn)'
+        }
+        if(jobId):
+            deleteArgs['ConditionExpression'] = 'attribute_exists(jobCompletedOn) AND (attribute_not_exists(jobId) OR jobId = :jobIdValue)'
+            deleteArgs['ExpressionAttributeValues'] = {':jobIdValue': jobId}
+
+        try:
+            table.delete_item(**deleteArgs)
+            return True
+        except ClientError as e:
+            if e.response['Error']['Code'] == "ConditionalCheckFailedException":
+                return False
+            raise
+
+    def getInFlightCount(self):
+
+        dynamodb = AwsHelper().getResource("dynamodb")
+        table = dynamodb.Table(self._controlTableName)
+
+        response = table.get_item(Key={ 'controlId': JobLedger.COUNTER_ID }, ConsistentRead=True)
+
+        if('Item' in response):
+            return int(response['Item'].get('inFlight', 0))
+        return 0
+
+    def getJobs(self):
+        # Job items and completed markers, which carry jobCompletedOn instead of jobStartedOn
+
+        dynamodb = AwsHelper().getResource("dynamodb")
+        table = dynamodb.Table(self._controlTableName)
+
+        scanArgs = { 'FilterExpression': Attr('controlId').begins_with(JobLedger.JOB_PREFIX) }
+        while(True):
+            response = table.scan(**scanArgs)
+            for item in response.get('Items', []):
+                yield item
+            if('LastEvaluatedKey' not in response):
+                break
+            scanArgs['ExclusiveStartKey'] = response['LastEvaluatedKey']
+
+    def releaseStaleJobs(self, maxAge):
+        # Releases jobs started longer than maxAge ago whose completion was
+        # never recorded and removes completed markers past MARKER_MAX_AGE
+        cutoff = str(datetime.datetime.utcnow() - maxAge)
+        markerCutoff = str(datetime.datetime.utcnow() - JobLedger.MARKER_MAX_AGE)
+        released = 0
+        for job in list(self.getJobs()):
+            documentId = job['controlId'][len(JobLedger.JOB_PREFIX):]
+            if('jobStartedOn' in job):
+                if(job['jobStartedOn'] < cutoff and self.recordJobCompleted(documentId, job.get('jobId'))):
+                    print("Released stale job {} for document {}".format(job.get('jobId'), documentId))
+                    released = released + 1
+            elif(job.get('jobCompletedOn', '') < markerCutoff):
+                self._deleteCompletedMarker(documentId)
+        return released
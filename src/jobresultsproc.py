@@ -2,44 +2,94 @@ import json
 import os
 import boto3
 import time
-from helper import AwsHelper
-from og import OutputGenerator
+import threading
+import queue
+from helper import AwsHelper, RetryHelper, QueueHelper
+from og import OutputGenerator, OutputCheckpoint
 import datastore
 
-def getJobResults(api, jobId):
-
-    pages = []
-
-    time.sleep(5)
-
-    client = AwsHelper().getClient('textract')
-    if(api == "StartDocumentTextDetection"):
-        response = client.get_document_text_detection(JobId=jobId)
-    else:
-        response = client.get_document_analysis(JobId=jobId)
-    pages.append(response)
-    print("Resultset page recieved: {}".format(len(pages)))
-    nextToken = None
-    if('NextToken' in response):
-        nextToken = response['NextToken']
-        print("Next token: {}".format(nextToken))
-
-    while(nextToken):
-        time.sleep(5)
-
-        if(api == "StartDocumentTextDetection"):
-            response = client.get_document_text_detection(JobId=jobId, NextToken=nextToken)
-        else:
-            response = client.get_document_analysis(JobId=jobId, NextToken=nextToken)
-
-        pages.append(response)
-        print("Resultset page recieved: {}".format(len(pages)))
-        nextToken = None
-        if('NextToken' in response):
-            nextToken = response['NextToken']
-            print("Next token: {}".format(nextToken))
-
-    return pages
+def getResultPage(client, api, jobId, nextToken, maxRetries=10):
+    # One Get* call. Throttling and transient errors are retried with
+    # jittered exponential backoff, anything else is raised.
+    args = { 'JobId' : jobId, 'MaxResults' : 1000 }
+    if(nextToken):
+        args['NextToken'] = nextToken
+
+    attempt = 0
+    while(True):
+        try:
+            if(api == "StartDocumentTextDetection"):
+                return client.get_document_text_detection(**args)
+            else:
+                return client.get_document_analysis(**args)
+        except Exception as e:
+            attempt = attempt + 1
+            throttled = RetryHelper.isThrottlingException(e)
+            if(not (throttled or RetryHelper.isTransientException(e)) or attempt > maxRetries):
+                raise
+            RetryHelper.backoff(attempt, "Throttled" if throttled else "Error {}".format(e), base=0.1, maxDelay=20)
+
+def fetchJobResults(api, jobId, nextToken, results, stop):
+    # Runs on a background thread and fetches result pages back to back,
+    # so the next page is on its way while the caller processes this one
+    try:
+        client = AwsHelper().getClient('textract', maxRetries=0)
+        pageCount = 0
+        while(not stop.is_set()):
+            start = time.perf_counter()
+            response = getResultPage(client, api, jobId, nextToken)
+            pageCount += 1
+            print("Resultset page recieved: {} in {:.2f}s".format(pageCount, time.perf_counter() - start))
+            QueueHelper.put(results, stop, ('page', response))
+            nextToken = response.get('NextToken')
+            if(not nextToken):
+                break
+        QueueHelper.put(results, stop, ('done', None))
+    except Exception as e:
+        QueueHelper.put(results, stop, ('error', e))
+
+def getJobResults(api, jobId, nextToken=None, prefetch=2):
+    # Yields each result page as soon as it is received, starting at
+    # nextToken if given. Up to prefetch pages are fetched ahead.
+
+    results = queue.Queue(maxsize=prefetch)
+    stop = threading.Event()
+    fetcher = threading.Thread(target=fetchJobResults, args=(api, jobId, nextToken, results, stop), daemon=True)
+    fetcher.start()
+    try:
+        while(True):
+            kind, value = results.get()
+            if(kind == 'page'):
+                yield value
+            elif(kind == 'error'):
+                raise value
+            else:
+                break
+    finally:
+        stop.set()
+
+def continueRequest(request):
+    # Queues the job completion message again so a new invocation resumes from the checkpoint
+    jobResultsQueueUrl = request.get('jobResultsQueueUrl')
+    if(not jobResultsQueueUrl):
+        raise Exception("Job {} stopped before completion and no JOB_RESULTS_QUEUE_URL is set to continue it.".format(request['jobId']))
+
+    # Requests built by lambda_handler_local carry no message; rebuild it from the request fields
+    message = request.get('message')
+    if(message is None):
+        message = {
+            'JobId' : request['jobId'],
+            'JobTag' : request['jobTag'],
+            'Status' : request['jobStatus'],
+            'API' : request['jobAPI'],
+            'DocumentLocation' : {
+                'S3Bucket' : request['bucketName'],
+                'S3ObjectName' : request['objectName']
+            }
+        }
+
+    sqs = AwsHelper().getClient('sqs')
+    sqs.send_message(QueueUrl=jobResultsQueueUrl, MessageBody=json.dumps({ 'Message' : json.dumps(message) }))
 
 def processRequest(request):
 
@@ -55,13 +105,7 @@ def processRequest(request):
     objectName = request['objectName']
     outputTable = request["outputTable"]
     documentsTable = request["documentsTable"]
-
-    pages = getJobResults(jobAPI, jobId)
-
-    print("Result pages recieved: {}".format(len(pages)))
-
-    dynamodb = AwsHelper().getResource("dynamodb")
-    ddb = dynamodb.Table(outputTable)
+    pageArchive = request.get("pageArchive", False)
 
     detectForms = False
     detectTables = False
@@ -72,8 +116,28 @@ def processRequest(request):
     dynamodb = AwsHelper().getResource('dynamodb')
     ddb = dynamodb.Table(outputTable)
 
-    opg = OutputGenerator(jobTag, pages, bucketName, objectName, detectForms, detectTables, ddb)
-    opg.run()
+    opg = OutputGenerator(jobTag, None, bucketName, objectName, detectForms, detectTables, ddb, pageArchive=pageArchive)
+
+    # Progress is checkpointed so a retry or a continuation resumes where this invocation stopped
+    checkpoint = OutputCheckpoint(bucketName, "{}checkpoint/".format(opg.outputPath),
+                                  getRemainingTime=request.get('getRemainingTime'))
+    state = checkpoint.load()
+    jobResults = getJobResults(jobAPI, jobId, state['nextToken'] if state else None)
+    try:
+        completed = opg.runStreaming(jobResults, checkpoint)
+    finally:
+        jobResults.close()
+
+    if(not completed):
+        continueRequest(request)
+        output = "Checkpointed -> Document: {} at page {}, continuing in a new invocation.".format(jobTag, opg.pagesEmitted)
+        print(output)
+        return {
+            'statusCode': 200,
+            'body': output
+        }
+
+    print("Result pages recieved: {}".format(opg.encoder.responseCount))
 
     print("DocumentId: {}".format(jobTag))
 
@@ -83,6 +147,7 @@ def processRequest(request):
     output = "Processed -> Document: {}, Object: {}/{} processed.".format(jobTag, bucketName, objectName)
 
     print(output)
+    print("AWS clients and resources created: {}".format(AwsHelper.getCreationCounts()))
 
     return {
         'statusCode': 200,
@@ -109,6 +174,11 @@ def lambda_handler(event, context):
     
     request["outputTable"] = os.environ['OUTPUT_TABLE']
     request["documentsTable"] = os.environ['DOCUMENTS_TABLE']
+    request["jobResultsQueueUrl"] = os.environ.get('JOB_RESULTS_QUEUE_URL')
+    request["pageArchive"] = os.environ.get('PAGE_ARCHIVE', 'false').lower() == 'true'
+    request["message"] = message
+    if(context):
+        request["getRemainingTime"] = context.get_remaining_time_in_millis
 
     return processRequest(request)
 
@@ -1,10 +1,305 @@
-import json
-from helper import FileHelper, S3Helper
-from trp import Document
+import struct
+import tempfile
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from helper import FileHelper, S3Helper, S3MultipartWriter, DynamoDBBatchWriter
+from trp import Document, DocumentBuilder
+import serializer
 import boto3
+from botocore.exceptions import ClientError
+
+class PageArchiveWriter:
+    # Consolidated per document output: every page artifact is appended as a
+    # 4 byte big endian length followed by its content, and a JSON index
+    # {"pages": {"<page>": {"<outputType>": [offset, length]}}} is written at
+    # the end, followed by the index length (8 bytes) and the magic again.
+    # Readers fetch the footer and then only the ranges they need.
+
+    MAGIC = b'TXTRPAGES1'
+
+    def __init__(self, stream, offset=0, index=None):
+        self._stream = stream
+        self._offset = offset
+        self._index = index if index is not None else {}
+        if(offset == 0):
+            self._write(PageArchiveWriter.MAGIC)
+
+    @staticmethod
+    def fromState(stream, state):
+        # Continues an archive from getState(); stream continues the upload
+        return PageArchiveWriter(stream, state['offset'], state['index'])
+
+    def getState(self):
+        return { 'offset' : self._offset, 'index' : self._index }
+
+    @property
+    def pageCount(self):
+        return len(self._index)
+
+    def _write(self, data):
+        self._stream.write(data)
+        self._offset += len(data)
+
+    def add(self, p, outputType, content):
+        if(isinstance(content, str)):
+            content = content.encode('utf-8')
+        self._write(struct.pack('>I', len(content)))
+        self._index.setdefault(str(p), {})[outputType] = [self._offset, len(content)]
+        self._write(content)
+
+    def close(self):
+        index = serializer.dumpsBytes({ "pages" : self._index })
+        self._write(index)
+        self._write(struct.pack('>Q', len(index)))
+        self._write(PageArchiveWriter.MAGIC)
+
+class PageArchive:
+    # Reads a page archive through readRange(start, end) -> bytes, so a page
+    # artifact costs one range request once the index is loaded.
+
+    def __init__(self, readRange, size):
+        self._readRange = readRange
+
+        footerSize = 8 + len(PageArchiveWriter.MAGIC)
+        footer = readRange(size - footerSize, size)
+        if(footer[8:] != PageArchiveWriter.MAGIC):
+            raise Exception("Not a page archive.")
+        indexLength = struct.unpack('>Q', footer[:8])[0]
+        indexStart = size - footerSize - indexLength
+        self._index = serializer.loads(readRange(indexStart, indexStart + indexLength))["pages"]
+
+    @staticmethod
+    def fromS3(bucketName, s3FileName, awsRegion=None):
+        size = S3Helper.getObjectSize(bucketName, s3FileName, awsRegion)
+        return PageArchive(lambda start, end: S3Helper.readRangeFromS3(bucketName, s3FileName, start, end, awsRegion), size)
+
+    @property
+    def pageCount(self):
+        return len(self._index)
+
+    def getOutputTypes(self, p):
+        return list(self._index.get(str(p), {}).keys())
+
+    def getArtifact(self, p, outputType):
+        entry = self._index.get(str(p), {}).get(outputType)
+        if(entry is None):
+            return None
+        offset, length = entry
+        return self._readRange(offset, offset + length)
+
+    def getText(self, p, outputType="Text"):
+        content = self.getArtifact(p, outputType)
+        if(content is None):
+            return None
+        return content.decode('utf-8')
+
+class ResponseEncoder:
+    # Encodes Textract response pages block by block into a spool file that
+    # becomes response.json. pageRanges gets one list of [start, end) ranges
+    # per page, one range per response page the page spans, so each page's
+    # blocks can be read back from the spool instead of being encoded again.
+    # With the json backend the output is byte for byte what json.dumps of
+    # the response returns. The spool moves to disk past spoolSize bytes.
+    # An encoder resumed from a checkpoint state only spools the bytes from
+    # the state's offset on, earlier bytes are already in S3; trim() drops
+    # bytes once they have been uploaded.
+
+    def __init__(self, isList=True, spoolSize=8 * 1024 * 1024):
+        self._file = tempfile.SpooledTemporaryFile(max_size=spoolSize)
+        self._spoolSize = spoolSize
+        self._base = 0
+        self._offset = 0
+        self._isList = isList
+        self._responseCount = 0
+        self.pageRanges = []
+
+    @staticmethod
+    def fromState(state, spoolSize=8 * 1024 * 1024):
+        encoder = ResponseEncoder(True, spoolSize)
+        encoder._base = state['offset']
+        encoder._offset = state['offset']
+        encoder._responseCount = state['responseCount']
+        encoder.pageRanges = state['pageRanges']
+        return encoder
+
+    def snapshot(self):
+        # Cheap marker of the current position; pageRanges only grows at the
+        # end, so truncating it to the marker restores it (see getState)
+        pageRanges = self.pageRanges
+        rangeCount = len(pageRanges[-1]) if pageRanges else 0
+        lastEnd = pageRanges[-1][-1][1] if rangeCount else None
+        return (self._offset, self._responseCount, len(pageRanges), rangeCount, lastEnd)
+
+    def getState(self, snapshot):
+        offset, responseCount, pageCount, rangeCount, lastEnd = snapshot
+        pageRanges = [[list(r) for r in ranges] for ranges in self.pageRanges[:pageCount]]
+        if(pageRanges):
+            del pageRanges[-1][rangeCount:]
+            if(rangeCount):
+                pageRanges[-1][-1][1] = lastEnd
+        return { 'offset' : offset, 'responseCount' : responseCount, 'pageRanges' : pageRanges }
+
+    @property
+    def offset(self):
+        return self._offset
+
+    def _write(self, data):
+        self._file.write(data)
+        self._offset += len(data)
+
+    def add(self, responsePage):
+        if(self._responseCount == 0):
+            opening = b"[{" if self._isList else b"{"
+        else:
+            opening = b", {"
+        self._responseCount += 1
+
+        pageRanges = self.pageRanges
+        offset = self._offset + len(opening)
+        parts = [opening]
+
+        for k, (key, value) in enumerate(responsePage.items()):
+            prefix = (b", " if k > 0 else b"") + serializer.dumpsBytes(key) + b": "
+            if(key != "Blocks"):
+                encoded = prefix + serializer.dumpsBytes(value)
+                parts.append(encoded)
+                offset += len(encoded)
+                continue
+
+            parts.append(prefix + b"[")
+            offset += len(prefix) + 1
+            for j, block in enumerate(value):
+                if(j > 0):
+                    parts.append(b", ")
+                    offset += 2
+                if(block['BlockType'] == 'PAGE'):
+                    pageRanges.append([])
+                if(pageRanges and (block['BlockType'] == 'PAGE' or j == 0)):
+                    pageRanges[-1].append([offset, offset])
+                encoded = serializer.dumpsBytes(block)
+                parts.append(encoded)
+                offset += len(encoded)
+                if(pageRanges):
+                    pageRanges[-1][-1][1] = offset
+            parts.append(b"]")
+            offset += 1
+
+        parts.append(b"}")
+        self._write(b"".join(parts))
+
+    def finish(self):
+        if(self._isList):
+            self._write(b"[]" if self._responseCount == 0 else b"]")
+
+    @property
+    def responseCount(self):
+        return self._responseCount
+
+    def getPageBlocks(self, pageNumber):
+        # Encoded blocks of a page as a JSON array, read back from the spool
+        fragments = []
+        for start, end in self.pageRanges[pageNumber - 1]:
+            self._file.seek(start - self._base)
+            fragments.append(self._file.read(end - start))
+        self._file.seek(0, 2)
+        return b"[" + b", ".join(fragments) + b"]"
+
+    def iterRange(self, start, end, chunkSize=8 * 1024 * 1024):
+        # Yields spooled bytes [start, end) of the output in chunks
+        while(start < end):
+            self._file.seek(start - self._base)
+            chunk = self._file.read(min(chunkSize, end - start))
+            start += len(chunk)
+            yield chunk
+        self._file.seek(0, 2)
+
+    def open(self):
+        self._file.seek(0)
+        return self._file
+
+    def trim(self, offset):
+        # Drops the spooled bytes before offset, which must be in S3 already.
+        # The spool is only rewritten once at least spoolSize bytes can go.
+        if(offset - self._base < self._spoolSize):
+            return
+        spool = tempfile.SpooledTemporaryFile(max_size=self._spoolSize)
+        for chunk in self.iterRange(offset, self._offset):
+            spool.write(chunk)
+        self._file.close()
+        self._file = spool
+        self._base = offset
+
+    def close(self):
+        self._file.close()
+
+class OutputCheckpoint:
+    # Progress of OutputGenerator.runStreaming kept in S3 under prefix, so a
+    # later invocation can resume instead of starting over. state.json
+    # holds the position and the uploads in progress; each upload's buffered
+    # tail is a separate object that state.json names. due() asks for a save
+    # every interval seconds, shouldStop() once less than reserve seconds of
+    # the invocation are left.
+
+    def __init__(self, bucketName, prefix, interval=60, getRemainingTime=None, reserve=120):
+        self.bucketName = bucketName
+        self.prefix = prefix
+        self.interval = interval
+        self.getRemainingTime = getRemainingTime
+        self.reserve = reserve
+        self.state = None
+        self.tails = {}
+        self._loaded = False
+        self._lastSave = time.monotonic()
+
+    def load(self):
+        if(not self._loaded):
+            self._loaded = True
+            try:
+                self.state = S3Helper.readJsonFromS3(self.bucketName, self.prefix + "state.json")
+            except ClientError as e:
+                if e.response['Error']['Code'] not in ("NoSuchKey", "404"):
+                    raise
+            if(self.state):
+                for name, tailPath in self.state['tailPaths'].items():
+                    self.tails[name] = b"".join(S3Helper.readStreamFromS3(self.bucketName, tailPath))
+        return self.state
+
+    def save(self, state, tails):
+        # tails maps an upload name to its buffered bytes
+        previousTails = self.state['tailPaths'].values() if self.state else []
+
+        state = dict(state, sequence=(self.state['sequence'] + 1) if self.state else 1)
+        state['tailPaths'] = {}
+        for name, tail in tails.items():
+            tailPath = "{}{}-{}.tail".format(self.prefix, name, state['sequence'])
+            S3Helper.writeToS3(tail, self.bucketName, tailPath)
+            state['tailPaths'][name] = tailPath
+        S3Helper.writeJsonToS3(state, self.bucketName, self.prefix + "state.json")
+        for tailPath in previousTails:
+            S3Helper.deleteFromS3(self.bucketName, tailPath)
+
+        self.state = state
+        self.tails = tails
+        self._lastSave = time.monotonic()
+        print("Checkpoint {} saved at page {}".format(state['sequence'], state['pagesEmitted']))
+
+    def clear(self):
+        if(self.state):
+            for tailPath in self.state['tailPaths'].values():
+                S3Helper.deleteFromS3(self.bucketName, tailPath)
+            S3Helper.deleteFromS3(self.bucketName, self.prefix + "state.json")
+        self.state = None
+        self.tails = {}
+
+    def due(self):
+        return time.monotonic() - self._lastSave >= self.interval
+
+    def shouldStop(self):
+        return self.getRemainingTime is not None and self.getRemainingTime() < self.reserve * 1000
 
 class OutputGenerator:
-    def __init__(self, documentId, response, bucketName, objectName, forms, tables, ddb):
+    def __init__(self, documentId, response, bucketName, objectName, forms, tables, ddb, maxInFlightPages=4, maxConcurrentWrites=8, pageObjects=True, pageArchive=False):
         self.documentId = documentId
         self.response = response
         self.bucketName = bucketName
@@ -12,10 +307,24 @@ class OutputGenerator:
         self.forms = forms
         self.tables = tables
         self.ddb = ddb
+        self.outputIndex = DynamoDBBatchWriter(ddb)
+        self.maxInFlightPages = maxInFlightPages
+        self.maxConcurrentWrites = maxConcurrentWrites
+        self.pageObjects = pageObjects
+        self.pageArchive = pageArchive
 
         self.outputPath = "{}-analysis/{}/".format(objectName, documentId)
 
-        self.document = Document(self.response)
+        self.document = None
+        self.encoder = None
+        self.checkpoint = None
+        self.responseWriter = None
+        self.archive = None
+        self.archiveStream = None
+        self.pagesEmitted = 0
+        self.completed = True
+        if(self.response is not None):
+            self.document = Document(self.response, lazy=True)
 
     def saveItem(self, pk, sk, output):
 
@@ -24,20 +333,22 @@ class OutputGenerator:
         jsonItem['outputType'] = sk
         jsonItem['outputPath'] = output
 
-        self.ddb.put_item(Item=jsonItem)
+        self.outputIndex.putItem(jsonItem)
+
+    # Each emitter yields (page, outputType, outputPath, content) artifacts for one page
 
-    def _outputText(self, page, p):
-        text = page.text
+    def _responseArtifacts(self, page, p):
+        opath = "{}page-{}-response.json".format(self.outputPath, p)
+        yield (p, "Response", opath, self.encoder.getPageBlocks(p))
+
+    def _textArtifacts(self, page, p):
         opath = "{}page-{}-text.txt".format(self.outputPath, p)
-        S3Helper.writeToS3(text, self.bucketName, opath)
-        self.saveItem(self.documentId, "page-{}-Text".format(p), opath)
+        yield (p, "Text", opath, page.text)
 
-        textInReadingOrder = page.getTextInReadingOrder()
         opath = "{}page-{}-text-inreadingorder.txt".format(self.outputPath, p)
-        S3Helper.writeToS3(textInReadingOrder, self.bucketName, opath)
-        self.saveItem(self.documentId, "page-{}-TextInReadingOrder".format(p), opath)
+        yield (p, "TextInReadingOrder", opath, page.getTextInReadingOrder())
 
-    def _outputForm(self, page, p):
+    def _formArtifacts(self, page, p):
         csvData = []
         for field in page.form.fields:
             csvItem  = []
@@ -52,10 +363,9 @@ class OutputGenerator:
             csvData.append(csvItem)
         csvFieldNames = ['Key', 'Value']
         opath = "{}page-{}-forms.csv".format(self.outputPath, p)
-        S3Helper.writeCSV(csvFieldNames, csvData, self.bucketName, opath)
-        self.saveItem(self.documentId, "page-{}-Forms".format(p), opath)
+        yield (p, "Forms", opath, S3Helper.getCSV(csvFieldNames, csvData))
 
-    def _outputTable(self, page, p):
+    def _tableArtifacts(self, page, p):
 
         csvData = []
         for table in page.tables:
@@ -71,37 +381,275 @@ class OutputGenerator:
             csvData.append([])
 
         opath = "{}page-{}-tables.csv".format(self.outputPath, p)
-        S3Helper.writeCSVRaw(csvData, self.bucketName, opath)
-        self.saveItem(self.documentId, "page-{}-Tables".format(p), opath)
+        yield (p, "Tables", opath, S3Helper.getCSVRaw(csvData))
+
+    def _pageArtifacts(self, pages):
+        # Pages are released as soon as their artifacts are built, only the artifact content stays in flight
+        for p, page in pages:
+            if(page is None):
+                # Checkpoint marker from _streamPages
+                yield None
+                continue
+            artifacts = []
+            artifacts.extend(self._responseArtifacts(page, p))
+            artifacts.extend(self._textArtifacts(page, p))
+            if(self.forms):
+                artifacts.extend(self._formArtifacts(page, p))
+            if(self.tables):
+                artifacts.extend(self._tableArtifacts(page, p))
+            page.release()
+            yield artifacts
+
+    def _submitArtifacts(self, executor, artifacts):
+        writes = []
+        for p, outputType, opath, content in artifacts:
+            future = executor.submit(S3Helper.writeToS3, content, self.bucketName, opath)
+            writes.append((p, outputType, opath, future))
+        return writes
+
+    def _completeWrites(self, writes):
+        # Index entries are saved on the calling thread once the object is in S3
+        for p, outputType, opath, future in writes:
+            future.result()
+            self.saveItem(self.documentId, "page-{}-{}".format(p, outputType), opath)
+
+    def _openPageArchive(self):
+        # Continues the archive upload of a resumed checkpoint, if any
+        archivePath = "{}pages.archive".format(self.outputPath)
+        state = self.checkpoint.state if self.checkpoint else None
+        if(state and 'archive' in state):
+            self.archiveStream = S3MultipartWriter.fromState(self.bucketName, archivePath, state['archive']['upload'], self.checkpoint.tails['archive'])
+            self.archive = PageArchiveWriter.fromState(self.archiveStream, state['archive']['writer'])
+        else:
+            self.archiveStream = S3MultipartWriter(self.bucketName, archivePath)
+            self.archive = PageArchiveWriter(self.archiveStream)
+        return archivePath
+
+    def _writePages(self, pages):
+        # S3 uploads run on a thread pool; at most maxInFlightPages pages have
+        # uploads outstanding, after that the pipeline waits for the oldest page
+        inFlight = deque()
+        pageCount = 0
+
+        archiveStream = None
+        archive = None
+        if(self.pageArchive):
+            archivePath = self._openPageArchive()
+            archiveStream = self.archiveStream
+            archive = self.archive
+
+        try:
+            with ThreadPoolExecutor(max_workers=self.maxConcurrentWrites) as executor:
+                for artifacts in self._pageArtifacts(pages):
+                    if(artifacts is None):
+                        while(inFlight):
+                            self._completeWrites(inFlight.popleft())
+                        self._saveCheckpoint()
+                        continue
+                    if(archive):
+                        for p, outputType, opath, content in artifacts:
+                            archive.add(p, outputType, content)
+                    if(self.pageObjects):
+                        if(len(inFlight) >= self.maxInFlightPages):
+                            self._completeWrites(inFlight.popleft())
+                        inFlight.append(self._submitArtifacts(executor, artifacts))
+                    pageCount = pageCount + 1
+                while(inFlight):
+                    self._completeWrites(inFlight.popleft())
+        except Exception:
+            if(archiveStream):
+                if(self.checkpoint):
+                    # A retry continues the upload from the last checkpoint
+                    archiveStream.detach()
+                else:
+                    archiveStream.abort()
+            raise
+
+        if(archive):
+            if(not self.completed):
+                archiveStream.detach()
+            elif(archive.pageCount > 0):
+                archive.close()
+                archiveStream.close()
+                self.saveItem(self.documentId, 'PageArchive', archivePath)
+            else:
+                archiveStream.abort()
+
+        return pageCount
+
+    def _streamPages(self, builder, responsePages):
+        # Pages are numbered from the encoder's page count, which is not zero
+        # when resuming. Pages up to pagesEmitted were written by an earlier
+        # invocation and are skipped. With a checkpoint a marker (p, None) is
+        # yielded between response pages when a save is due; the run stops
+        # after it once the invocation is running out of time. Each page is
+        # released from the builder once its artifacts are built, and
+        # response pages are not kept, so memory does not grow with the document.
+        p = len(self.encoder.pageRanges)
+        resumedPages = self.pagesEmitted
+        checkpoint = self.checkpoint
+        nextToken = checkpoint.state['nextToken'] if (checkpoint and checkpoint.state) else None
+
+        # Where a later invocation resumes: the start of the response page
+        # holding the PAGE block of the oldest page not output yet. Pages
+        # waiting for related blocks can be held back behind later ones, so
+        # the start of every such page is kept until it is output.
+        self._resumePoint = (self.encoder.snapshot(), nextToken)
+        startOffset = self.encoder.offset
+        pageStarts = deque()
+
+        for responsePage in responsePages:
+            snapshot = self.encoder.snapshot()
+            self.encoder.add(responsePage)
+            for i in range(snapshot[2], len(self.encoder.pageRanges)):
+                pageStarts.append((snapshot, nextToken))
+            nextToken = responsePage.get('NextToken')
+
+            for page in builder.add(responsePage):
+                p = p + 1
+                if(p > resumedPages):
+                    yield (p, page)
+                builder.release(page)
+                pageStarts.popleft()
+            responsePage = None
+            self.pagesEmitted = max(p, resumedPages)
+            if(pageStarts):
+                self._resumePoint = pageStarts[0]
+            self._uploadResponse()
+
+            if(checkpoint and nextToken):
+                # Only stop once the resume point has moved, so every invocation makes progress
+                stop = checkpoint.shouldStop() and self._resumePoint[0][0] > startOffset
+                if(stop or checkpoint.due()):
+                    yield (p, None)
+                if(stop):
+                    print("Stopping at page {} to continue in a new invocation.".format(self.pagesEmitted))
+                    self.completed = False
+                    return
+
+        for page in builder.finish():
+            p = p + 1
+            if(p > resumedPages):
+                yield (p, page)
+            builder.release(page)
+        self.pagesEmitted = max(p, resumedPages)
+
+    def _uploadResponse(self):
+        # response.json bytes before the resume point are final: they go to
+        # the upload and are dropped from the spool, which then only holds
+        # the pages not output yet. Later bytes may still be encoded again
+        # by a resumed run, so they are not uploaded.
+        offset = self._resumePoint[0][0]
+        for chunk in self.encoder.iterRange(self.responseWriter.bytesWritten, offset):
+            self.responseWriter.write(chunk)
+        self.encoder.trim(offset)
+
+    def _saveCheckpoint(self):
+        # Page writes are complete at this point. response.json bytes up to
+        # the resume point go to the upload, the index entries to DynamoDB.
+        snapshot, nextToken = self._resumePoint
+        self._uploadResponse()
+        uploadState, tail = self.responseWriter.getState()
+        self.outputIndex.flush()
+
+        state = {
+            'nextToken' : nextToken,
+            'pagesEmitted' : self.pagesEmitted,
+            'encoder' : self.encoder.getState(snapshot),
+            'upload' : uploadState
+        }
+        tails = { 'response' : tail }
+        if(self.archive):
+            # The archive holds exactly the pages up to pagesEmitted here
+            archiveUpload, tails['archive'] = self.archiveStream.getState()
+            state['archive'] = { 'upload' : archiveUpload, 'writer' : self.archive.getState() }
+        self.checkpoint.save(state, tails)
+
+    def _outputResponse(self):
+        opath = "{}response.json".format(self.outputPath)
+        if(self.responseWriter):
+            # Streaming run: earlier bytes were uploaded while streaming, maybe in an earlier invocation
+            for chunk in self.encoder.iterRange(self.responseWriter.bytesWritten, self.encoder.offset):
+                self.responseWriter.write(chunk)
+            self.responseWriter.close()
+        else:
+            S3Helper.writeStreamToS3(self.encoder.open(), self.bucketName, opath)
+        self.saveItem(self.documentId, 'Response', opath)
+
+        # Byte ranges of each page's blocks in response.json, see trp.PageLoader
+        opath = "{}response-index.json".format(self.outputPath)
+        S3Helper.writeJsonToS3({ "pages" : self.encoder.pageRanges }, self.bucketName, opath)
+        self.saveItem(self.documentId, 'ResponseIndex', opath)
 
     def run(self):
 
         if(not self.document.pages):
             return
 
-        opath = "{}response.json".format(self.outputPath)
-        S3Helper.writeToS3(json.dumps(self.response), self.bucketName, opath)
-        self.saveItem(self.documentId, 'Response', opath)
+        # Blocks are encoded once; response.json and the page responses share the encoding
+        self.encoder = ResponseEncoder(isinstance(self.response, list))
+        try:
+            responsePages = self.response if isinstance(self.response, list) else [self.response]
+            for responsePage in responsePages:
+                self.encoder.add(responsePage)
+            self.encoder.finish()
 
-        print("Total Pages in Document: {}".format(len(self.document.pages)))
+            self._outputResponse()
 
-        docText = ""
+            print("Total Pages in Document: {}".format(len(self.document.pages)))
 
-        p = 1
-        for page in self.document.pages:
+            self._writePages(enumerate(self.document.pages, 1))
+        finally:
+            self.encoder.close()
 
-            opath = "{}page-{}-response.json".format(self.outputPath, p)
-            S3Helper.writeToS3(json.dumps(page.blocks), self.bucketName, opath)
-            self.saveItem(self.documentId, "page-{}-Response".format(p), opath)
+        self.outputIndex.flush()
 
-            self._outputText(page, p)
+    def runStreaming(self, responsePages, checkpoint=None):
+        # Output each page as soon as it is complete while later response pages are still being fetched.
+        # With a checkpoint (see OutputCheckpoint) the run resumes from its
+        # saved state, if any; responsePages must then start at the state's
+        # nextToken. Returns False if the run stopped early to be continued.
+        builder = DocumentBuilder(lazy=True)
 
-            docText = docText + page.text + "\n"
+        self.checkpoint = checkpoint
+        self.completed = True
+        responsePath = "{}response.json".format(self.outputPath)
+        state = checkpoint.load() if checkpoint else None
 
-            if(self.forms):
-                self._outputForm(page, p)
+        if(state):
+            print("Resuming after page {}".format(state['pagesEmitted']))
+            self.encoder = ResponseEncoder.fromState(state['encoder'])
+            self.responseWriter = S3MultipartWriter.fromState(self.bucketName, responsePath, state['upload'], checkpoint.tails['response'])
+            self.pagesEmitted = state['pagesEmitted']
+        else:
+            self.encoder = ResponseEncoder()
+            self.responseWriter = S3MultipartWriter(self.bucketName, responsePath)
 
-            if(self.tables):
-                self._outputTable(page, p)
+        try:
+            self._writePages(self._streamPages(builder, responsePages))
+
+            if(not self.completed):
+                return False
+
+            print("Total Pages in Document: {}".format(self.pagesEmitted))
+
+            if(self.pagesEmitted > 0):
+                self.encoder.finish()
+                self._outputResponse()
+            else:
+                self.responseWriter.abort()
+        except Exception:
+            if(not checkpoint):
+                # Nothing resumes this upload
+                self.responseWriter.abort()
+            raise
+        finally:
+            self.encoder.close()
+            if(self.responseWriter):
+                self.responseWriter.detach()
+
+        self.outputIndex.flush()
+        if(checkpoint):
+            checkpoint.clear()
 
-            p = p + 1
\ No newline at end of file
+        return True
@@ -0,0 +1,100 @@
+import os
+import json
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import ujson
+except ImportError:
+    ujson = None
+
+# JSON backend shared by the pipeline. orjson or ujson are used when they are
+# installed (e.g. added to a layer), otherwise the standard library. Set
+# JSON_SERIALIZER to "json", "ujson" or "orjson" to pick one explicitly.
+# Backends differ in whitespace but all produce and accept standard JSON.
+
+class StdlibBackend:
+    name = "json"
+
+    @staticmethod
+    def dumps(obj):
+        return json.dumps(obj)
+
+    @staticmethod
+    def dumpsBytes(obj):
+        # json.dumps escapes non ASCII characters, so the str is already ASCII
+        return json.dumps(obj).encode('ascii')
+
+    @staticmethod
+    def loads(data):
+        return json.loads(data)
+
+class UjsonBackend:
+    name = "ujson"
+
+    @staticmethod
+    def dumps(obj):
+        return ujson.dumps(obj, escape_forward_slashes=False)
+
+    @staticmethod
+    def dumpsBytes(obj):
+        return ujson.dumps(obj, escape_forward_slashes=False).encode('utf-8')
+
+    @staticmethod
+    def loads(data):
+        return ujson.loads(data)
+
+class OrjsonBackend:
+    name = "orjson"
+
+    @staticmethod
+    def dumps(obj):
+        return orjson.dumps(obj).decode('utf-8')
+
+    @staticmethod
+    def dumpsBytes(obj):
+        return orjson.dumps(obj)
+
+    @staticmethod
+    def loads(data):
+        return orjson.loads(data)
+
+def availableBackends():
+    backends = []
+    if(orjson is not None):
+        backends.append(OrjsonBackend)
+    if(ujson is not None):
+        backends.append(UjsonBackend)
+    backends.append(StdlibBackend)
+    return backends
+
+def getBackend(name=None):
+    backends = availableBackends()
+    if(name):
+        for backend in backends:
+            if(backend.name == name):
+                return backend
+        print("JSON serializer {} is not available, using {}.".format(name, backends[0].name))
+    return backends[0]
+
+_backend = getBackend(os.environ.get('JSON_SERIALIZER'))
+
+def setBackend(name):
+    global _backend
+    _backend = getBackend(name)
+    return _backend
+
+def backendName():
+    return _backend.name
+
+def dumps(obj):
+    return _backend.dumps(obj)
+
+def dumpsBytes(obj):
+    return _backend.dumpsBytes(obj)
+
+def loads(data):
+    return _backend.loads(data)
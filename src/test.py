@@ -9,15 +9,19 @@ import helper
 import uuid
 import json
 import datastore
+import datetime
+import trp
 
 # Update variables below according to your infrastructure
 # You only need this if you want to test lambda code locally
 syncQueueUrl = "https://sqs.us-east-1.amazonaws.com/xxxxxxxxxx/TextractPipeline-SyncJobs0FE0C444-BBR6E631F0I6"
 asyncQueueUrl = "https://sqs.us-east-1.amazonaws.com/xxxxxxxxxx/TextractPipeline-AsyncJobsE9347181-1SV1MLXM1UILD"
+jobResultsQueueUrl = "https://sqs.us-east-1.amazonaws.com/xxxxxxxxxx/TextractPipeline-JobResults3A5E5F8B-1Q2W3E4R5T6Y"
 bucketName = "textractpipeline-documentsbucket9ec9deb9-ofohi06s79gi"
 
 documentsTableName = "TextractPipeline-DocumentsTable7E808EE5-8IXG1Z8GJDHB"
 outputTableName = "TextractPipeline-OutputTable875D8E18-13GV0UL4BOW6R"
+controlTableName = "TextractPipeline-ControlTable2C9E3D4F-1X2Y3Z4A5B6C"
 
 snsTopic = "arn:aws:sns:us-east-1:xxxxxxxxxx:TextractPipeline-JobCompletionF65D4017-ASSENX3JLRKZ"
 snsRole = "arn:aws:iam::xxxxxxxxxx:role/TextractPipeline-TextractServiceRole720C3B18-BS7XGG84Z4WH"
@@ -31,6 +35,8 @@ def clearEnvironment():
     os.environ['ASYNC_QUEUE_URL'] = ""
     os.environ['DOCUMENTS_TABLE'] = ""
     os.environ['OUTPUT_TABLE'] = ""
+    os.environ['CONTROL_TABLE'] = ""
+    os.environ['JOB_RESULTS_QUEUE_URL'] = ""
     os.environ['SNS_TOPIC_ARN'] = ""
     os.environ['SNS_ROLE_ARN'] = ""
 
@@ -102,6 +108,7 @@ def processAsyncJobs():
     os.environ['SNS_TOPIC_ARN'] = snsTopic
     os.environ['SNS_ROLE_ARN'] = snsRole
     os.environ['ASYNC_QUEUE_URL'] = asyncQueueUrl
+    os.environ['CONTROL_TABLE'] = controlTableName
 
     asyncproc.lambda_handler(event, None)
 
@@ -116,9 +123,17 @@ def processJobResults():
     clearEnvironment()    
     os.environ['OUTPUT_TABLE'] = outputTableName
     os.environ['DOCUMENTS_TABLE'] = documentsTableName
+    os.environ['JOB_RESULTS_QUEUE_URL'] = jobResultsQueueUrl
 
     jobresultsproc.lambda_handler(event, None)
 
+def jobLedger_getJobs():
+
+        ledger = datastore.JobLedger(controlTableName)
+        print("Jobs in flight: {}".format(ledger.getInFlightCount()))
+        for job in ledger.getJobs():
+            print(job)
+
 def dataStore_getDocuments():
         
         #Document
@@ -133,6 +148,43 @@ def dataStore_getDocuments():
             print(docs)
         print("------------")
 
+def dataStore_scanDocuments(documentStatus="IN_PROGRESS", totalSegments=8):
+
+        dstore = datastore.DocumentStore(documentsTableName, outputTableName)
+        for doc in dstore.scanDocuments(totalSegments, projection=['documentId', 'objectName'], documentStatus=documentStatus):
+            print(doc)
+        print(dstore.countDocumentsByStatus(totalSegments))
+
+def dataStore_getStuckDocuments(hours=1):
+
+        dstore = datastore.DocumentStore(documentsTableName, outputTableName)
+        for doc in dstore.getStuckDocuments(datetime.timedelta(hours=hours)):
+            print(doc)
+
+def dataStore_backfillStatusShards(totalSegments=8):
+
+        dstore = datastore.DocumentStore(documentsTableName, outputTableName)
+        dstore.backfillStatusShards(totalSegments)
+
+def dataStore_createDocuments(documentCount=250, objectName=s3Pdf):
+
+        # Creates documentCount records with bulk transactions, then marks them complete
+        dstore = datastore.DocumentStore(documentsTableName, outputTableName)
+        documentIds = [str(uuid.uuid1()) for i in range(documentCount)]
+        errors = dstore.createDocuments([(documentId, bucketName, objectName) for documentId in documentIds])
+        print("Created {} documents, errors: {}".format(documentCount - len(errors), errors))
+        errors = dstore.markDocumentsComplete(documentIds)
+        print("Completed {} documents, errors: {}".format(documentCount - len(errors), errors))
+
+def loadResponsePage(documentId, pageNumber, objectName=s3Pdf):
+
+        # Reads one page of response.json through response-index.json and S3 range requests
+        outputPath = "{}-analysis/{}/".format(objectName, documentId)
+        pageIndex = helper.S3Helper.readJsonFromS3(bucketName, outputPath + "response-index.json")
+        loader = trp.PageLoader(pageIndex, lambda start, end: helper.S3Helper.readRangeFromS3(bucketName, outputPath + "response.json", start, end))
+        page = loader.getPage(pageNumber)
+        print(page.text)
+
 #Sync Pipeline
 #createImageDocument()
 #processImageDocument("822927b4-7798-11e9-8495-4a0007597ab0")
@@ -1,6 +1,198 @@
 import json
+try:
+    import serializer
+except ImportError:
+    serializer = json
+from bisect import bisect_left, bisect_right
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+class BlockIndex:
+    """Slot-addressed index over the blocks of Textract response pages.
+
+    Every block gets an integer slot in stream order. CHILD and VALUE
+    relationships are resolved once into slot lists, so the trp object graph
+    is built without looking block ids up again. evict() drops the blocks
+    before a slot once they are no longer needed; slots stay the same.
+    """
+
+    def __init__(self, responsePages=None):
+        self._base = 0
+        self._blocks = []
+        self._blockTypes = []
+        self._slots = {}
+        self._children = []
+        self._values = []
+        self._parents = []
+        self._typeSlots = {}
+        self._pageStarts = []
+        self._pending = {}
+
+        if(responsePages):
+            for responsePage in responsePages:
+                self.add(responsePage['Blocks'])
+            self.dropUnresolved()
+
+    def __len__(self):
+        return self._base + len(self._blocks)
+
+    def _link(self, slot, ids, targets, isChild):
+        for cid in ids:
+            cslot = self._slots.get(cid)
+            if(cslot is None):
+                # Target has not been seen yet, fill the slot in when it arrives
+                self._pending.setdefault(cid, []).append((slot, targets, len(targets), isChild))
+                targets.append(-1)
+            else:
+                targets.append(cslot)
+                if(isChild):
+                    self._parents[cslot - self._base] = slot
+
+    def add(self, blocks):
+        for block in blocks:
+            slot = self._base + len(self._blocks)
+            blockType = block['BlockType']
+
+            self._blocks.append(block)
+            self._blockTypes.append(blockType)
+            self._slots[block['Id']] = slot
+            self._parents.append(-1)
+            self._typeSlots.setdefault(blockType, []).append(slot)
+            if(blockType == 'PAGE'):
+                self._pageStarts.append(slot)
+
+            children = ()
+            values = ()
+            if('Relationships' in block and block['Relationships']):
+                for rs in block['Relationships']:
+                    if(rs['Type'] == 'CHILD'):
+                        if(not children):
+                            children = []
+                        self._link(slot, rs['Ids'], children, True)
+                    elif(rs['Type'] == 'VALUE'):
+                        if(not values):
+                            values = []
+                        self._link(slot, rs['Ids'], values, False)
+            self._children.append(children)
+            self._values.append(values)
+
+            waiting = self._pending.pop(block['Id'], None)
+            if(waiting):
+                for parentSlot, targets, i, isChild in waiting:
+                    targets[i] = slot
+                    if(isChild):
+                        self._parents[slot - self._base] = parentSlot
+
+    def dropUnresolved(self):
+        # Removes relationships to blocks that never arrived, so no -1 slot is
+        # left in children or values. Called once all blocks have been added.
+        if(not self._pending):
+            return 0
+        targetLists = {}
+        for waiting in self._pending.values():
+            for parentSlot, targets, i, isChild in waiting:
+                targetLists[id(targets)] = targets
+        for targets in targetLists.values():
+            targets[:] = [t for t in targets if t >= 0]
+        missing = len(self._pending)
+        self._pending = {}
+        print("WARNING: {} related blocks are missing from the response. Ignoring relationships to them.".format(missing))
+        return missing
+
+    def evict(self, end):
+        # Drops the blocks before slot end, e.g. pages that have been output.
+        # If a later block still references one of them, eviction stops at the
+        # first referenced block. Ids of evicted blocks no longer resolve, a
+        # block added later that references one waits as unresolved.
+        keep = end
+        for i in range(max(0, end - self._base), len(self._blocks)):
+            for targets in (self._children[i], self._values[i]):
+                for cslot in targets:
+                    if(0 <= cslot < keep):
+                        keep = cslot
+
+        count = keep - self._base
+        if(count <= 0):
+            return 0
+        for block in self._blocks[:count]:
+            self._slots.pop(block['Id'], None)
+        del self._blocks[:count]
+        del self._blockTypes[:count]
+        del self._children[:count]
+        del self._values[:count]
+        del self._parents[:count]
+        for slots in self._typeSlots.values():
+            del slots[:bisect_left(slots, keep)]
+        self._base = keep
+        return count
+
+    def block(self, slot):
+        return self._blocks[slot - self._base]
+
+    def blockType(self, slot):
+        return self._blockTypes[slot - self._base]
+
+    def children(self, slot):
+        return self._children[slot - self._base]
+
+    def values(self, slot):
+        return self._values[slot - self._base]
+
+    def parent(self, slot):
+        return self._parents[slot - self._base]
+
+    def blocksInRange(self, start, end):
+        return self._blocks[start - self._base:end - self._base]
+
+    def slotOf(self, blockId):
+        return self._slots.get(blockId)
+
+    def slotsOfType(self, blockType):
+        return self._typeSlots.get(blockType, [])
+
+    def slotsInRange(self, blockType, start, end):
+        slots = self._typeSlots.get(blockType, [])
+        return slots[bisect_left(slots, start):bisect_left(slots, end)]
+
+    def pageCount(self):
+        return len(self._pageStarts)
+
+    def pageRange(self, i):
+        start = self._pageStarts[i]
+        if(i + 1 < len(self._pageStarts)):
+            end = self._pageStarts[i + 1]
+        else:
+            end = len(self)
+        return (start, end)
+
+    def pageRanges(self):
+        return [self.pageRange(i) for i in range(len(self._pageStarts))]
+
+    def hasPending(self, start, end):
+        # True if a block in [start, end) still references a block that has not been added
+        for waiting in self._pending.values():
+            for parentSlot, targets, i, isChild in waiting:
+                if(start <= parentSlot < end):
+                    return True
+        return False
+
+    def getBlockById(self, blockId):
+        block = None
+        slot = self._slots.get(blockId)
+        if(slot is not None):
+            block = self.block(slot)
+        return block
+
+    @property
+    def blocks(self):
+        return self._blocks
 
 class BoundingBox:
+    __slots__ = ('_width', '_height', '_left', '_top')
+
     def __init__(self, width, height, left, top):
         self._width = width
         self._height = height
@@ -27,6 +219,8 @@ class BoundingBox:
         return self._top
 
 class Polygon:
+    __slots__ = ('_x', '_y')
+
     def __init__(self, x, y):
         self._x = x
         self._y = y
@@ -43,16 +237,21 @@ class Polygon:
         return self._y
 
 class Geometry:
+    # Polygon points are kept as a flat (x0, y0, x1, y1, ...) tuple and only
+    # turned into Polygon objects when the polygon property is read.
+    __slots__ = ('_boundingBox', '_points')
+
     def __init__(self, geometry):
         boundingBox = geometry["BoundingBox"]
         polygon = geometry["Polygon"]
         bb = BoundingBox(boundingBox["Width"], boundingBox["Height"], boundingBox["Left"], boundingBox["Top"])
-        pgs = []
+        points = []
         for pg in polygon:
-            pgs.append(Polygon(pg["X"], pg["Y"]))
+            points.append(pg["X"])
+            points.append(pg["Y"])
 
         self._boundingBox = bb
-        self._polygon = pgs
+        self._points = tuple(points)
 
     def __str__(self):
         s = "BoundingBox: {}\n".format(str(self._boundingBox))
@@ -62,12 +261,110 @@ class Geometry:
     def boundingBox(self):
         return self._boundingBox
 
+    @property
+    def polygon(self):
+        pgs = []
+        for i in range(0, len(self._points), 2):
+            pgs.append(Polygon(self._points[i], self._points[i + 1]))
+        return pgs
+
+class GeometryStore:
+    """Columnar geometry for a set of blocks, usually the lines or words of a page.
+
+    Row i describes blocks[slots[i]] of the block index. Bounding boxes are
+    contiguous float arrays and polygons an (n, points, 2) array padded with
+    NaN, so spatial queries run as array operations. Requires NumPy.
+    """
+
+    def __init__(self, blockIndex, slots):
+        if(np is None):
+            raise ImportError("NumPy is required for the trp geometry store.")
+
+        boxes = []
+        polygons = []
+        pointCount = 0
+        for slot in slots:
+            geometry = blockIndex.block(slot)['Geometry']
+            bb = geometry['BoundingBox']
+            boxes.append((bb['Left'], bb['Top'], bb['Width'], bb['Height']))
+            polygon = [(pg['X'], pg['Y']) for pg in geometry['Polygon']]
+            polygons.append(polygon)
+            pointCount = max(pointCount, len(polygon))
+
+        self._slots = np.asarray(slots, dtype=np.int64)
+        self._boxes = np.asarray(boxes, dtype=np.float64).reshape(len(boxes), 4)
+        self._polygon = np.full((len(polygons), pointCount, 2), np.nan)
+        for i, polygon in enumerate(polygons):
+            if(polygon):
+                self._polygon[i, :len(polygon)] = polygon
+
+    def __len__(self):
+        return len(self._slots)
+
+    @property
+    def slots(self):
+        return self._slots
+
+    @property
+    def left(self):
+        return self._boxes[:, 0]
+
+    @property
+    def top(self):
+        return self._boxes[:, 1]
+
+    @property
+    def width(self):
+        return self._boxes[:, 2]
+
+    @property
+    def height(self):
+        return self._boxes[:, 3]
+
+    @property
+    def right(self):
+        return self._boxes[:, 0] + self._boxes[:, 2]
+
+    @property
+    def bottom(self):
+        return self._boxes[:, 1] + self._boxes[:, 3]
+
+    @property
+    def centreX(self):
+        return self._boxes[:, 0] + self._boxes[:, 2] / 2
+
+    @property
+    def centreY(self):
+        return self._boxes[:, 1] + self._boxes[:, 3] / 2
+
     @property
     def polygon(self):
         return self._polygon
 
+    def intersecting(self, left, top, width, height):
+        """Return the row indexes of boxes that overlap the given region."""
+        mask = ((self.left < left + width) & (self.right > left)
+                & (self.top < top + height) & (self.bottom > top))
+        return np.flatnonzero(mask)
+
+    def within(self, left, top, width, height):
+        """Return the row indexes of boxes that lie entirely inside the given region."""
+        mask = ((self.left >= left) & (self.right <= left + width)
+                & (self.top >= top) & (self.bottom <= top + height))
+        return np.flatnonzero(mask)
+
+    def overlaps(self, other=None):
+        """Return an (n, m) boolean matrix of pairwise box overlaps with other (or self)."""
+        if(other is None):
+            other = self
+        return ((self.left[:, None] < other.right[None, :]) & (self.right[:, None] > other.left[None, :])
+                & (self.top[:, None] < other.bottom[None, :]) & (self.bottom[:, None] > other.top[None, :]))
+
 class Word:
-    def __init__(self, block, blockMap):
+    __slots__ = ('_block', '_confidence', '_geometry', '_id', '_text')
+
+    def __init__(self, blockIndex, slot):
+        block = blockIndex.block(slot)
         self._block = block
         self._confidence = block['Confidence']
         self._geometry = Geometry(block['Geometry'])
@@ -100,8 +397,11 @@ class Word:
         return self._block
 
 class Line:
-    def __init__(self, block, blockMap):
+    __slots__ = ('_block', '_confidence', '_geometry', '_id', '_text', '_words')
+
+    def __init__(self, blockIndex, slot):
 
+        block = blockIndex.block(slot)
         self._block = block
         self._confidence = block['Confidence']
         self._geometry = Geometry(block['Geometry'])
@@ -112,12 +412,9 @@ class Line:
             self._text = block['Text']
 
         self._words = []
-        if('Relationships' in block and block['Relationships']):
-            for rs in block['Relationships']:
-                if(rs['Type'] == 'CHILD'):
-                    for cid in rs['Ids']:
-                        if(blockMap[cid]["BlockType"] == "WORD"):
-                            self._words.append(Word(blockMap[cid], blockMap))
+        for cslot in blockIndex.children(slot):
+            if(blockIndex.blockType(cslot) == "WORD"):
+                self._words.append(Word(blockIndex, cslot))
     def __str__(self):
         s = "Line\n==========\n"
         s = s + self._text + "\n"
@@ -151,7 +448,10 @@ class Line:
         return self._block
 
 class SelectionElement:
-    def __init__(self, block, blockMap):
+    __slots__ = ('_confidence', '_geometry', '_id', '_selectionStatus')
+
+    def __init__(self, blockIndex, slot):
+        block = blockIndex.block(slot)
         self._confidence = block['Confidence']
         self._geometry = Geometry(block['Geometry'])
         self._id = block['Id']
@@ -174,7 +474,8 @@ class SelectionElement:
         return self._selectionStatus
 
 class FieldKey:
-    def __init__(self, block, children, blockMap):
+    def __init__(self, blockIndex, slot, children):
+        block = blockIndex.block(slot)
         self._block = block
         self._confidence = block['Confidence']
         self._geometry = Geometry(block['Geometry'])
@@ -184,10 +485,9 @@ class FieldKey:
 
         t = []
 
-        for eid in children:
-            wb = blockMap[eid]
-            if(wb['BlockType'] == "WORD"):
-                w = Word(wb, blockMap)
+        for cslot in children:
+            if(blockIndex.blockType(cslot) == "WORD"):
+                w = Word(blockIndex, cslot)
                 self._content.append(w)
                 t.append(w.text)
 
@@ -222,7 +522,8 @@ class FieldKey:
         return self._block
 
 class FieldValue:
-    def __init__(self, block, children, blockMap):
+    def __init__(self, blockIndex, slot, children):
+        block = blockIndex.block(slot)
         self._block = block
         self._confidence = block['Confidence']
         self._geometry = Geometry(block['Geometry'])
@@ -232,14 +533,14 @@ class FieldValue:
 
         t = []
 
-        for eid in children:
-            wb = blockMap[eid]
-            if(wb['BlockType'] == "WORD"):
-                w = Word(wb, blockMap)
+        for cslot in children:
+            blockType = blockIndex.blockType(cslot)
+            if(blockType == "WORD"):
+                w = Word(blockIndex, cslot)
                 self._content.append(w)
                 t.append(w.text)
-            elif(wb['BlockType'] == "SELECTION_ELEMENT"):
-                se = SelectionElement(wb, blockMap)
+            elif(blockType == "SELECTION_ELEMENT"):
+                se = SelectionElement(blockIndex, cslot)
                 self._content.append(se)
                 self._text = se.selectionStatus
 
@@ -274,21 +575,19 @@ class FieldValue:
         return self._block
 
 class Field:
-    def __init__(self, block, blockMap):
+    def __init__(self, blockIndex, slot):
         self._key = None
         self._value = None
 
-        for item in block['Relationships']:
-            if(item["Type"] == "CHILD"):
-                self._key = FieldKey(block, item['Ids'], blockMap)
-            elif(item["Type"] == "VALUE"):
-                for eid in item['Ids']:
-                    vkvs = blockMap[eid]
-                    if 'VALUE' in vkvs['EntityTypes']:
-                        if('Relationships' in vkvs):
-                            for vitem in vkvs['Relationships']:
-                                if(vitem["Type"] == "CHILD"):
-                                    self._value = FieldValue(vkvs, vitem['Ids'], blockMap)
+        children = blockIndex.children(slot)
+        if(children):
+            self._key = FieldKey(blockIndex, slot, children)
+
+        for vslot in blockIndex.values(slot):
+            if 'VALUE' in blockIndex.block(vslot)['EntityTypes']:
+                vchildren = blockIndex.children(vslot)
+                if(vchildren):
+                    self._value = FieldValue(blockIndex, vslot, vchildren)
     def __str__(self):
         s = "\nField\n==========\n"
         k = ""
@@ -342,8 +641,11 @@ class Form:
         return results
 
 class Cell:
+    __slots__ = ('_block', '_confidence', '_rowIndex', '_columnIndex', '_rowSpan', '_columnSpan',
+                 '_geometry', '_id', '_content', '_text')
 
-    def __init__(self, block, blockMap):
+    def __init__(self, blockIndex, slot):
+        block = blockIndex.block(slot)
         self._block = block
         self._confidence = block['Confidence']
         self._rowIndex = block['RowIndex']
@@ -354,19 +656,16 @@ class Cell:
         self._id = block['Id']
         self._content = []
         self._text = ""
-        if('Relationships' in block and block['Relationships']):
-            for rs in block['Relationships']:
-                if(rs['Type'] == 'CHILD'):
-                    for cid in rs['Ids']:
-                        blockType = blockMap[cid]["BlockType"]
-                        if(blockType == "WORD"):
-                            w = Word(blockMap[cid], blockMap)
-                            self._content.append(w)
-                            self._text = self._text + w.text + ' '
-                        elif(blockType == "SELECTION_ELEMENT"):
-                            se = SelectionElement(blockMap[cid], blockMap)
-                            self._content.append(se)
-                            self._text = self._text + se.selectionStatus + ', '
+        for cslot in blockIndex.children(slot):
+            blockType = blockIndex.blockType(cslot)
+            if(blockType == "WORD"):
+                w = Word(blockIndex, cslot)
+                self._content.append(w)
+                self._text = self._text + w.text + ' '
+            elif(blockType == "SELECTION_ELEMENT"):
+                se = SelectionElement(blockIndex, cslot)
+                self._content.append(se)
+                self._text = self._text + se.selectionStatus + ', '
 
     def __str__(self):
         return self._text
@@ -427,8 +726,9 @@ class Row:
 
 class Table:
 
-    def __init__(self, block, blockMap):
+    def __init__(self, blockIndex, slot):
 
+        block = blockIndex.block(slot)
         self._block = block
 
         self._confidence = block['Confidence']
@@ -440,18 +740,15 @@ class Table:
         ri = 1
         row = Row()
         cell = None
-        if('Relationships' in block and block['Relationships']):
-            for rs in block['Relationships']:
-                if(rs['Type'] == 'CHILD'):
-                    for cid in rs['Ids']:
-                        cell = Cell(blockMap[cid], blockMap)
-                        if(cell.rowIndex > ri):
-                            self._rows.append(row)
-                            row = Row()
-                            ri = cell.rowIndex
-                        row.cells.append(cell)
-                    if(row and row.cells):
-                        self._rows.append(row)
+        for cslot in blockIndex.children(slot):
+            cell = Cell(blockIndex, cslot)
+            if(cell.rowIndex > ri):
+                self._rows.append(row)
+                row = Row()
+                ri = cell.rowIndex
+            row.cells.append(cell)
+        if(row and row.cells):
+            self._rows.append(row)
 
     def __str__(self):
         s = "Table\n==========\n"
@@ -480,70 +777,173 @@ class Table:
     def block(self):
         return self._block
 
-class Page:
+def _readingOrder(left, width, top):
+    """Assign each box to a text column and order boxes column by column, top to bottom.
+
+    Boxes are visited narrowest first so body lines seed columns before wide
+    headers do; fragments narrower than half the median width (page numbers,
+    short paragraph endings) are visited last so they cannot seed a column
+    that body lines would then join. A box joins a column when its centre
+    falls inside the column or it spans the column's centre, otherwise it
+    starts a new column. A box whose centre falls inside a column widens it
+    to cover the box, up to the neighbouring columns, so a column seeded by
+    a short line grows to the width of its body text. Columns are kept
+    sorted and apart so each lookup is a bisect,
+    which makes the whole pass O(n log n). Returns the column index of every
+    box, numbered left to right, and the box indexes in reading order.
+    """
+    colLefts = []
+    colRights = []
+    colCentres = []
+    colIds = []
+    columns = [0] * len(left)
+
+    byWidth = sorted(range(len(left)), key=lambda i: width[i])
+    if(byWidth):
+        minSeedWidth = width[byWidth[len(byWidth) // 2]] / 2
+        byWidth = ([i for i in byWidth if width[i] >= minSeedWidth]
+                   + [i for i in byWidth if width[i] < minSeedWidth])
+
+    for i in byWidth:
+        boxLeft = left[i]
+        boxRight = boxLeft + width[i]
+        boxCentre = boxLeft + width[i] / 2
+
+        column = None
+        k = bisect_right(colLefts, boxCentre) - 1
+        if(k >= 0 and boxCentre < colRights[k]):
+            column = colIds[k]
+            if(boxLeft < colLefts[k] or boxRight > colRights[k]):
+                if(k > 0):
+                    boxLeft = max(boxLeft, colRights[k - 1])
+                if(k + 1 < len(colLefts)):
+                    boxRight = min(boxRight, colLefts[k + 1])
+                colLefts[k] = min(colLefts[k], boxLeft)
+                colRights[k] = max(colRights[k], boxRight)
+                colCentres[k] = (colLefts[k] + colRights[k]) / 2
+        else:
+            k = bisect_right(colCentres, boxLeft)
+            if(k < len(colCentres) and colCentres[k] < boxRight):
+                column = colIds[k]
+
+        if(column is None):
+            column = len(colIds)
+            k = bisect_right(colLefts, boxLeft)
+            colLefts.insert(k, boxLeft)
+            colRights.insert(k, boxRight)
+            colCentres.insert(k, boxCentre)
+            colIds.insert(k, column)
+        columns[i] = column
+
+    rank = [0] * len(colIds)
+    for k, column in enumerate(colIds):
+        rank[column] = k
+    columns = [rank[column] for column in columns]
+
+    order = sorted(range(len(left)), key=lambda i: (columns[i], top[i]))
+    return columns, order
 
-    def __init__(self, blocks, blockMap):
-        self._blocks = blocks
-        self._text = ""
-        self._lines = []
-        self._form = Form()
-        self._tables = []
-        self._content = []
+class Page:
 
-        self._parse(blockMap)
+    def __init__(self, blockIndex, start, end, lazy=False):
+        self._blockIndex = blockIndex
+        self._start = start
+        self._end = end
+        self._blocks = blockIndex.blocksInRange(start, end)
+        self._text = None
+        self._lines = None
+        self._form = None
+        self._fieldSlots = None
+        self._tables = None
+        self._content = None
+        self._lineGeometry = None
+        self._wordGeometry = None
+
+        item = blockIndex.block(start)
+        self._geometry = Geometry(item['Geometry'])
+        self._id = item['Id']
+
+        if(not lazy):
+            self._parseContent()
 
     def __str__(self):
         s = "Page\n==========\n"
-        for item in self._content:
+        for item in self.content:
             s = s + str(item) + "\n"
         return s
 
-    def _parse(self, blockMap):
-        for item in self._blocks:
-            if item["BlockType"] == "PAGE":
-                self._geometry = Geometry(item['Geometry'])
-                self._id = item['Id']
-            elif item["BlockType"] == "LINE":
-                l = Line(item, blockMap)
-                self._lines.append(l)
-                self._content.append(l)
-                self._text = self._text + l.text + '\n'
-            elif item["BlockType"] == "TABLE":
-                t = Table(item, blockMap)
-                self._tables.append(t)
-                self._content.append(t)
-            elif item["BlockType"] == "KEY_VALUE_SET":
-                if 'KEY' in item['EntityTypes']:
-                    f = Field(item, blockMap)
-                    if(f.key):
-                        self._form.addField(f)
-                        self._content.append(f)
-                    else:
-                        print("WARNING: Detected K/V where key does not have content. Excluding key from output.")
-                        print(f)
-                        print(item)
+    def _parseLines(self):
+        self._lines = []
+        text = []
+        for slot in self._blockIndex.slotsInRange("LINE", self._start, self._end):
+            l = Line(self._blockIndex, slot)
+            self._lines.append(l)
+            text.append(l.text + '\n')
+        self._text = ''.join(text)
+
+    def _parseTables(self):
+        self._tables = []
+        for slot in self._blockIndex.slotsInRange("TABLE", self._start, self._end):
+            self._tables.append(Table(self._blockIndex, slot))
+
+    def _parseForm(self):
+        self._form = Form()
+        self._fieldSlots = []
+        for slot in self._blockIndex.slotsInRange("KEY_VALUE_SET", self._start, self._end):
+            item = self._blockIndex.block(slot)
+            if 'KEY' in item['EntityTypes']:
+                f = Field(self._blockIndex, slot)
+                if(f.key):
+                    self._form.addField(f)
+                    self._fieldSlots.append(slot)
+                else:
+                    print("WARNING: Detected K/V where key does not have content. Excluding key from output.")
+                    print(f)
+                    print(item)
+
+    def _parseContent(self):
+        lines = iter(self.lines)
+        tables = iter(self.tables)
+        fields = iter(self.form.fields)
+        fieldSlots = set(self._fieldSlots)
+
+        self._content = []
+        for slot in range(self._start, self._end):
+            blockType = self._blockIndex.blockType(slot)
+            if blockType == "LINE":
+                self._content.append(next(lines))
+            elif blockType == "TABLE":
+                self._content.append(next(tables))
+            elif blockType == "KEY_VALUE_SET" and slot in fieldSlots:
+                self._content.append(next(fields))
 
     def getLinesInReadingOrder(self):
-        columns = []
-        lines = []
-        for item in self._lines:
-                column_found=False
-                for index, column in enumerate(columns):
-                    bbox_left = item.geometry.boundingBox.left
-                    bbox_right = item.geometry.boundingBox.left + item.geometry.boundingBox.width
-                    bbox_centre = item.geometry.boundingBox.left + item.geometry.boundingBox.width/2
-                    column_centre = column['left'] + column['right']/2
-                    if (bbox_centre > column['left'] and bbox_centre < column['right']) or (column_centre > bbox_left and column_centre < bbox_right):
-                        #Bbox appears inside the column
-                        lines.append([index, item.text])
-                        column_found=True
-                        break
-                if not column_found:
-                    columns.append({'left':item.geometry.boundingBox.left, 'right':item.geometry.boundingBox.left + item.geometry.boundingBox.width})
-                    lines.append([len(columns)-1, item.text])
-
-        lines.sort(key=lambda x: x[0])
-        return lines
+        lines = self.lines
+        if(self._lineGeometry is not None):
+            # Only reused when already built, building it costs more than the sort
+            geometry = self._lineGeometry
+            left = geometry.left.tolist()
+            width = geometry.width.tolist()
+            top = geometry.top.tolist()
+        else:
+            boxes = [line.geometry.boundingBox for line in lines]
+            left = [bb.left for bb in boxes]
+            width = [bb.width for bb in boxes]
+            top = [bb.top for bb in boxes]
+
+        columns, order = _readingOrder(left, width, top)
+        return [[columns[i], lines[i].text] for i in order]
+
+    def release(self):
+        # Drop everything parsed from the blocks, it is rebuilt on next access
+        self._text = None
+        self._lines = None
+        self._form = None
+        self._fieldSlots = None
+        self._tables = None
+        self._content = None
+        self._lineGeometry = None
+        self._wordGeometry = None
 
     def getTextInReadingOrder(self):
         lines = self.getLinesInReadingOrder()
@@ -558,24 +958,49 @@ class Page:
 
     @property
     def text(self):
+        if(self._text is None):
+            self._parseLines()
         return self._text
 
     @property
     def lines(self):
+        if(self._lines is None):
+            self._parseLines()
         return self._lines
 
     @property
     def form(self):
+        if(self._form is None):
+            self._parseForm()
         return self._form
 
     @property
     def tables(self):
+        if(self._tables is None):
+            self._parseTables()
         return self._tables
 
     @property
     def content(self):
+        if(self._content is None):
+            self._parseContent()
         return self._content
 
+    @property
+    def lineGeometry(self):
+        # Rows line up with self.lines
+        if(self._lineGeometry is None):
+            slots = self._blockIndex.slotsInRange("LINE", self._start, self._end)
+            self._lineGeometry = GeometryStore(self._blockIndex, slots)
+        return self._lineGeometry
+
+    @property
+    def wordGeometry(self):
+        if(self._wordGeometry is None):
+            slots = self._blockIndex.slotsInRange("WORD", self._start, self._end)
+            self._wordGeometry = GeometryStore(self._blockIndex, slots)
+        return self._wordGeometry
+
     @property
     def geometry(self):
         return self._geometry
@@ -586,7 +1011,7 @@ class Page:
 
 class Document:
 
-    def __init__(self, responsePages):
+    def __init__(self, responsePages, lazy=False):
 
         if(not isinstance(responsePages, list)):
             rps = []
@@ -594,6 +1019,7 @@ class Document:
             responsePages = rps
 
         self._responsePages = responsePages
+        self._lazy = lazy
         self._pages = []
 
         self._parse()
@@ -604,34 +1030,14 @@ class Document:
             s = s + str(p) + "\n\n"
         return s
 
-    def _parseDocumentPagesAndBlockMap(self):
-
-        blockMap = {}
-
-        documentPages = []
-        documentPage = None
-        for page in self._responsePages:
-            for block in page['Blocks']:
-                if('BlockType' in block and 'Id' in block):
-                    blockMap[block['Id']] = block
-
-                if(block['BlockType'] == 'PAGE'):
-                    if(documentPage):
-                        documentPages.append({"Blocks" : documentPage})
-                    documentPage = []
-                    documentPage.append(block)
-                else:
-                    documentPage.append(block)
-        if(documentPage):
-            documentPages.append({"Blocks" : documentPage})
-        return documentPages, blockMap
-
     def _parse(self):
 
-        self._responseDocumentPages, self._blockMap = self._parseDocumentPagesAndBlockMap()
-        for documentPage in self._responseDocumentPages:
-            page = Page(documentPage["Blocks"], self._blockMap)
+        self._blockIndex = BlockIndex(self._responsePages)
+        self._responseDocumentPages = []
+        for start, end in self._blockIndex.pageRanges():
+            page = Page(self._blockIndex, start, end, self._lazy)
             self._pages.append(page)
+            self._responseDocumentPages.append({"Blocks" : page.blocks})
 
     @property
     def blocks(self):
@@ -645,9 +1051,84 @@ class Document:
     def pages(self):
         return self._pages
 
-    def getBlockById(self, blockId):
-        block = None
-        if(self._blockMap and blockId in self._blockMap):
-            block = self._blockMap[blockId]
-        return block
+    @property
+    def blockIndex(self):
+        return self._blockIndex
 
+    def getBlockById(self, blockId):
+        return self._blockIndex.getBlockById(blockId)
+
+class DocumentBuilder:
+    """Builds trp Pages incrementally from Textract response pages as they arrive.
+
+    A page is emitted once the PAGE block of the next page has been seen and
+    all of its relationships resolve, so pages that span several response
+    pages are only emitted when complete. Call finish() after the last
+    response page to emit the remaining pages. The builder keeps no pages or
+    response pages; release() a page once it has been output to drop its
+    blocks, so memory is bounded by the pages in flight.
+    """
+
+    def __init__(self, lazy=False):
+        self._blockIndex = BlockIndex()
+        self._pageCount = 0
+        self._lazy = lazy
+
+    def _completedPages(self, final):
+        completed = []
+        pageCount = self._blockIndex.pageCount()
+        while(self._pageCount < pageCount):
+            i = self._pageCount
+            start, end = self._blockIndex.pageRange(i)
+            if(not final and (i + 1 == pageCount or self._blockIndex.hasPending(start, end))):
+                break
+            completed.append(Page(self._blockIndex, start, end, self._lazy))
+            self._pageCount += 1
+        return completed
+
+    def add(self, responsePage):
+        self._blockIndex.add(responsePage['Blocks'])
+        return self._completedPages(False)
+
+    def finish(self):
+        self._blockIndex.dropUnresolved()
+        return self._completedPages(True)
+
+    def release(self, page):
+        # The page can not be parsed again afterwards
+        page.release()
+        self._blockIndex.evict(page._end)
+
+    @property
+    def pageCount(self):
+        return self._pageCount
+
+    @property
+    def blockIndex(self):
+        return self._blockIndex
+
+class PageLoader:
+    """Loads single pages of a response.json written by OutputGenerator.
+
+    pageIndex is the parsed response-index.json, which holds the byte ranges
+    of each page's blocks. readRange(start, end) returns bytes [start, end) of
+    response.json, e.g. through an S3 range GET, so loading a page reads only
+    that page's blocks.
+    """
+
+    def __init__(self, pageIndex, readRange):
+        self._pageRanges = pageIndex["pages"]
+        self._readRange = readRange
+
+    @property
+    def pageCount(self):
+        return len(self._pageRanges)
+
+    def getPageBlocks(self, pageNumber):
+        fragments = [self._readRange(start, end) for start, end in self._pageRanges[pageNumber - 1]]
+        return serializer.loads(b"[" + b", ".join(fragments) + b"]")
+
+    def getPage(self, pageNumber, lazy=False):
+        blocks = self.getPageBlocks(pageNumber)
+        blockIndex = BlockIndex([{ "Blocks" : blocks }])
+        return Page(blockIndex, 0, len(blocks), lazy)
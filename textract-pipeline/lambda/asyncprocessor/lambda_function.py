@@ -1,15 +1,20 @@
 import json
 import boto3
 import os
-from helper import AwsHelper
+from helper import AwsHelper, RetryHelper
+import datastore
 import time
+import datetime
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
 def startJob(bucketName, objectName, documentId, snsTopic, snsRole, detectForms, detectTables):
 
     print("Starting job with documentId: {}, bucketName: {}, objectName: {}".format(documentId, bucketName, objectName))
 
     response = None
-    client = AwsHelper().getClient('textract')
+    # No client side retries, throttling is handled by the RateController
+    client = AwsHelper().getClient('textract', maxRetries=0)
     if(not detectForms and not detectTables):
         response = client.start_document_text_detection(
             ClientRequestToken  = documentId,
@@ -49,7 +54,7 @@ def startJob(bucketName, objectName, documentId, snsTopic, snsRole, detectForms,
     return response["JobId"]
 
 
-def processItem(message, snsTopic, snsRole):
+def processItem(message, snsTopic, snsRole, jobLedger=None):
 
     print('message:')
     print(message)
@@ -75,88 +80,248 @@ def processItem(message, snsTopic, snsRole):
 
     if(jobId):
         print("Started Job with Id: {}".format(jobId))
+        if(jobLedger):
+            # The job is running, so a ledger failure must not send the
+            # message back to the queue. An unrecorded job is not counted.
+            try:
+                jobLedger.recordJobStarted(documentId, jobId)
+            except Exception as e:
+                print("Failed to record job {} in the job ledger: {}".format(jobId, e))
 
     return jobId
 
-def changeVisibility(sqs, qUrl, receipt_handle):
+RATE_CONTROL_ID = "textract-start-rate"
+
+class RateController:
+    # Paces Start* calls with a token bucket whose rate is adjusted AIMD
+    # style: every started job adds increase / rate TPS (about increase TPS
+    # per second at full pace) and a throttle multiplies the rate by
+    # decrease, at most once per second. throttleRate remembers the rate of
+    # the last throttle; near it the rate grows ten times slower, so
+    # submissions settle just under the limit. getState/fromState carry the
+    # learned rate across invocations.
+
+    def __init__(self, rate=1.0, minRate=0.1, maxRate=50.0, increase=0.5, decrease=0.5, throttleRate=None):
+        self.rate = rate
+        self.minRate = minRate
+        self.maxRate = maxRate
+        self.increase = increase
+        self.decrease = decrease
+        self.throttleRate = throttleRate
+        self.limitExceededOn = None
+        self.startedCount = 0
+        self.throttleCount = 0
+
+        self._lock = threading.Lock()
+        self._tokens = 1.0
+        self._lastRefill = time.monotonic()
+        self._lastDecrease = 0
+        self._createdOn = time.monotonic()
+
+    @staticmethod
+    def fromState(state, **kwargs):
+        controller = RateController(**kwargs)
+        if(state):
+            controller.rate = min(controller.maxRate, max(controller.minRate, state.get('rate', controller.rate)))
+            controller.throttleRate = state.get('throttleRate')
+            controller.limitExceededOn = state.get('limitExceededOn')
+        return controller
+
+    def getState(self):
+        return {
+            'rate' : self.rate,
+            'throttleRate' : self.throttleRate,
+            'observedRate' : self.observedRate,
+            'limitExceededOn' : self.limitExceededOn,
+            'updatedOn' : str(datetime.datetime.utcnow())
+        }
+
+    @property
+    def observedRate(self):
+        elapsed = time.monotonic() - self._createdOn
+        return self.startedCount / elapsed if elapsed > 0 else 0.0
+
+    def acquire(self):
+        # Takes a token, sleeping until one is available. Tokens are reserved
+        # under the lock so concurrent callers are spaced 1 / rate apart.
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(max(1.0, self.rate), self._tokens + (now - self._lastRefill) * self.rate)
+            self._lastRefill = now
+            self._tokens -= 1
+            wait = -self._tokens / self.rate if self._tokens < 0 else 0
+        if(wait > 0):
+            time.sleep(wait)
+
+    def onSuccess(self):
+        with self._lock:
+            self.startedCount += 1
+            step = self.increase / max(self.rate, 1.0)
+            if(self.throttleRate and self.rate >= 0.9 * self.throttleRate):
+                step = step / 10
+            self.rate = min(self.maxRate, self.rate + step)
+
+    def onThrottle(self):
+        with self._lock:
+            self.throttleCount += 1
+            now = time.monotonic()
+            if(now - self._lastDecrease < 1.0):
+                return
+            self._lastDecrease = now
+            self.throttleRate = self.rate
+            self.rate = max(self.minRate, self.rate * self.decrease)
+            self._tokens = min(self._tokens, 0.0)
+            print("Throttled, rate lowered to {:.2f} TPS".format(self.rate))
+
+    def onLimitExceeded(self):
+        with self._lock:
+            self.limitExceededOn = str(datetime.datetime.utcnow())
+
+def tryProcessItem(message, snsTopic, snsRole, hitLimit, rateController, jobLedger):
+    # Runs on a worker thread. Returns (started, exception); once any job of
+    # the batch hits the concurrent job limit the remaining messages are not
+    # attempted. Throttled messages go back to the queue at a lower rate.
+    if(hitLimit.is_set()):
+        return False, None
+    rateController.acquire()
+    if(hitLimit.is_set()):
+        return False, None
+    try:
+        processItem(message, snsTopic, snsRole, jobLedger)
+        rateController.onSuccess()
+        return True, None
+    except Exception as e:
+        print("Error while starting job: {}".format(e))
+        if(RetryHelper.isLimitException(e)):
+            rateController.onLimitExceeded()
+            hitLimit.set()
+        elif(RetryHelper.isThrottlingException(e)):
+            rateController.onThrottle()
+        return False, e
+
+def deleteMessages(sqs, qUrl, messages):
+    if(not messages):
+        return
     try:
-        sqs.change_message_visibility(
+        response = sqs.delete_message_batch(
                 QueueUrl=qUrl,
-                ReceiptHandle=receipt_handle,
-                VisibilityTimeout=0
+                Entries=[{ 'Id' : str(i), 'ReceiptHandle' : message['ReceiptHandle'] } for i, message in enumerate(messages)]
             )
+        # Undeleted messages become visible again; ClientRequestToken makes restarting their jobs idempotent
+        for failed in response.get('Failed', []):
+            print("Failed to delete message {} with error: {}".format(failed['Id'], failed.get('Message')))
     except Exception as e:
-        print("Failed to change visibility for {} with error: {}".format(receipt_handle, e))
+        print("Failed to delete {} messages with error: {}".format(len(messages), e))
 
-def getMessagesFromQueue(sqs, qUrl,):
-    # Receive message from SQS queue
+def changeVisibility(sqs, qUrl, messages):
+    if(not messages):
+        return
+    try:
+        response = sqs.change_message_visibility_batch(
+                QueueUrl=qUrl,
+                Entries=[{ 'Id' : str(i), 'ReceiptHandle' : message['ReceiptHandle'], 'VisibilityTimeout' : 0 } for i, message in enumerate(messages)]
+            )
+        for failed in response.get('Failed', []):
+            print("Failed to change visibility for message {} with error: {}".format(failed['Id'], failed.get('Message')))
+    except Exception as e:
+        print("Failed to change visibility for {} messages with error: {}".format(len(messages), e))
+
+def getMessagesFromQueue(sqs, qUrl, maxMessages=10):
+    # Receive up to maxMessages messages, at most 10 (the SQS maximum for one call)
     response = sqs.receive_message(
         QueueUrl=qUrl,
-        MaxNumberOfMessages=1,
+        MaxNumberOfMessages=min(10, maxMessages),
         VisibilityTimeout=60 #14400
     )
 
-    print('SQS Response Recieved:')
-    print(response)
-
     if('Messages' in response):
+        print('SQS Response Recieved: {} messages'.format(len(response['Messages'])))
         return response['Messages']
     else:
         print("No messages in queue.")
         return None
 
-def processItems(qUrl, snsTopic, snsRole):
+def processItems(executor, rateController, jobLedger, qUrl, snsTopic, snsRole, maxMessages=10):
 
     sqs = AwsHelper().getClient('sqs')
-    messages = getMessagesFromQueue(sqs, qUrl)
+    messages = getMessagesFromQueue(sqs, qUrl, maxMessages)
 
     jc = 0
     totalMessages = 0
-    hitLimit = False
     limitException = None
 
     if(messages):
 
-
         totalMessages = len(messages)
         print("Total messages: {}".format(totalMessages))
 
-        for message in messages:
-            receipt_handle = message['ReceiptHandle']
-
-            try:
-                if(hitLimit):
-                    changeVisibility(sqs, qUrl, receipt_handle)
-                else:
-                    print("starting job...")
-                    processItem(message, snsTopic, snsRole)
-                    print("started job...")
-                    print('Deleting item from queue...')
-                    # Delete received message from queue
-                    sqs.delete_message(
-                        QueueUrl=qUrl,
-                        ReceiptHandle=receipt_handle
-                    )
-                    print('Deleted item from queue...')
-                    jc += 1
-            except Exception as e:
-                print("Error while starting job or deleting from queue: {}".format(e))
-                changeVisibility(sqs, qUrl, receipt_handle)
-                if(e.__class__.__name__ == 'LimitExceededException' 
-                    or e.__class__.__name__ == "ProvisionedThroughputExceededException"):
-                    hitLimit = True
+        # Jobs of the batch start concurrently, at most the executor's worker count at a time
+        hitLimit = threading.Event()
+        futures = [executor.submit(tryProcessItem, message, snsTopic, snsRole, hitLimit, rateController, jobLedger) for message in messages]
+
+        startedMessages = []
+        returnedMessages = []
+        for message, future in zip(messages, futures):
+            started, e = future.result()
+            if(started):
+                startedMessages.append(message)
+            else:
+                returnedMessages.append(message)
+                if(e is not None and RetryHelper.isLimitException(e)):
                     limitException = e
 
-        if(hitLimit):
-            raise limitException
+        print('Deleting {} items from queue...'.format(len(startedMessages)))
+        deleteMessages(sqs, qUrl, startedMessages)
+        changeVisibility(sqs, qUrl, returnedMessages)
+        jc = len(startedMessages)
 
-    return totalMessages, jc
+    return totalMessages, jc, limitException
 
 def processRequest(request):
 
     qUrl = request['qUrl']
     snsTopic = request['snsTopic']
     snsRole = request['snsRole']
+    maxConcurrency = request.get('maxConcurrency', 4)
+    getRemainingTime = request.get('getRemainingTime')
+    controlTable = request.get('controlTable')
+
+    # The learned submission rate is kept in the control table between invocations
+    controlStore = None
+    state = None
+    if(controlTable):
+        controlStore = datastore.ControlStore(controlTable)
+        try:
+            state = controlStore.getState(RATE_CONTROL_ID)
+        except Exception as e:
+            print("Failed to read the submission rate, starting from the default: {}".format(e))
+    rateController = RateController.fromState(state)
+    print("Submission rate: {:.2f} TPS".format(rateController.rate))
+
+    # With a job ledger only as many jobs start as there are free slots under
+    # maxJobs. Completed jobs are released here only, from the job completion
+    # notices this function receives; stale jobs only on the scheduled run.
+    # Ledger failures are logged and do not stop job submission.
+    jobLedger = None
+    freeSlots = None
+    if(controlTable):
+        jobLedger = datastore.JobLedger(controlTable)
+        for documentId, jobId in request.get('completedJobs', []):
+            try:
+                jobLedger.recordJobCompleted(documentId, jobId)
+            except Exception as e:
+                print("Failed to record completion of job {} in the job ledger: {}".format(jobId, e))
+        if(request.get('releaseStaleJobs')):
+            try:
+                jobLedger.releaseStaleJobs(datetime.timedelta(hours=request.get('jobTimeoutHours', 24)))
+            except Exception as e:
+                print("Failed to release stale jobs in the job ledger: {}".format(e))
+        try:
+            inFlight = jobLedger.getInFlightCount()
+            freeSlots = request.get('maxJobs', 100) - inFlight
+            print("Jobs in flight: {}, free slots: {}".format(inFlight, freeSlots))
+        except Exception as e:
+            print("Failed to read jobs in flight, starting jobs without the ledger limit: {}".format(e))
 
     i = 0
     max = 100
@@ -164,35 +329,48 @@ def processRequest(request):
     totalJobsScheduled = 0
 
     hitLimit = False
-    provisionedThroughputExceededCount = 0
 
-    while(i < max):
-        try:
-            tc, jc = processItems(qUrl, snsTopic, snsRole)
-
-            totalJobsScheduled += jc
-
-            if(tc == 0):
-                i = max
+    try:
+        with ThreadPoolExecutor(max_workers=maxConcurrency) as executor:
+            while(i < max):
+                # Leave time to return the last batch to the queue before the function times out
+                if(getRemainingTime and getRemainingTime() < 15000):
+                    print("Stopping before timeout.")
+                    break
+
+                if(freeSlots is not None and freeSlots <= 0):
+                    print("No free job slots.")
+                    break
+
+                try:
+                    maxMessages = 10 if freeSlots is None else min(10, freeSlots)
+                    tc, jc, limitException = processItems(executor, rateController, jobLedger, qUrl, snsTopic, snsRole, maxMessages)
+
+                    totalJobsScheduled += jc
+                    if(freeSlots is not None):
+                        freeSlots -= jc
+
+                    if(limitException):
+                        raise limitException
+
+                    if(tc == 0):
+                        i = max
+
+                except Exception as e:
+                    if(e.__class__.__name__ == 'LimitExceededException'):
+                        print("Exception: Hit limit.")
+                        hitLimit = True
+                        i = max
+
+                i += 1
+    finally:
+        if(controlStore):
+            try:
+                controlStore.putState(RATE_CONTROL_ID, rateController.getState())
+            except Exception as e:
+                print("Failed to save the submission rate: {}".format(e))
 
-        except Exception as e:
-            if(e.__class__.__name__ == 'LimitExceededException'):
-                print("Exception: Hit limit.")
-                hitLimit = True
-                i = max
-            elif(e.__class__.__name__ == "ProvisionedThroughputExceededException"):
-                print("ProvisionedThroughputExceededException.")
-                provisionedThroughputExceededCount += 1
-                if(provisionedThroughputExceededCount > 5):
-                    i = max
-                else:
-                    print("Waiting for few seconds...")
-                    time.sleep(5)
-                    print("Waking up...")
-
-        i += 1
-
-    output = "Started {} jobs.".format(totalJobsScheduled)
+    output = "Started {} jobs at {:.2f} TPS, {} throttled.".format(totalJobsScheduled, rateController.observedRate, rateController.throttleCount)
     if(hitLimit):
         output += " Hit limit."
 
@@ -212,5 +390,22 @@ def lambda_handler(event, context):
     request["qUrl"] = os.environ['ASYNC_QUEUE_URL']
     request["snsTopic"] = os.environ['SNS_TOPIC_ARN']
     request["snsRole"] = os.environ['SNS_ROLE_ARN']
+    request["maxConcurrency"] = int(os.environ.get('ASYNC_MAX_CONCURRENCY', '4'))
+    request["controlTable"] = os.environ.get('CONTROL_TABLE')
+    request["maxJobs"] = int(os.environ.get('ASYNC_MAX_JOBS', '100'))
+    if(context):
+        request["getRemainingTime"] = context.get_remaining_time_in_millis
+
+    # Job completion notifications also trigger this function; release their slots first
+    completedJobs = []
+    for record in event.get('Records', []):
+        if('Sns' in record):
+            message = json.loads(record['Sns']['Message'])
+            if('JobTag' in message):
+                completedJobs.append((message['JobTag'], message.get('JobId')))
+    request["completedJobs"] = completedJobs
+
+    # The stale job sweep scans the control table, so it only runs on the schedule
+    request["releaseStaleJobs"] = (event.get('detail-type') == "Scheduled Event")
 
     return processRequest(request)
@@ -1,9 +1,19 @@
 import boto3
 from botocore.client import Config
 import os
+import threading
+import time
+import random
+import queue
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
 import csv
 import io
+import json
+import codecs
+import serializer
 from boto3.dynamodb.conditions import Key
+import botocore.exceptions
 
 class DynamoDBHelper:
 
@@ -49,34 +59,285 @@ class DynamoDBHelper:
                     })
                 print("Deleted...")
 
+class RetryHelper:
+    # Error checks and backoff shared by the code that retries AWS calls itself
+
+    THROTTLING_CODES = ("ProvisionedThroughputExceededException", "ThrottlingException")
+    TRANSIENT_CODES = ("InternalServerError", "InternalFailure", "ServiceUnavailable", "RequestTimeout")
+
+    @staticmethod
+    def getErrorCode(e):
+        # Modeled exceptions are named after their code, a generic ClientError carries it
+        if(isinstance(e, botocore.exceptions.ClientError)):
+            return e.response.get('Error', {}).get('Code', e.__class__.__name__)
+        return e.__class__.__name__
+
+    @staticmethod
+    def isThrottlingException(e):
+        return RetryHelper.getErrorCode(e) in RetryHelper.THROTTLING_CODES
+
+    @staticmethod
+    def isLimitException(e):
+        return RetryHelper.getErrorCode(e) == "LimitExceededException"
+
+    @staticmethod
+    def isTransientException(e):
+        # Server side and connection errors that usually go away on a retry
+        if(isinstance(e, (botocore.exceptions.ConnectionError, botocore.exceptions.HTTPClientError))):
+            return True
+        if(isinstance(e, botocore.exceptions.ClientError)):
+            status = e.response.get('ResponseMetadata', {}).get('HTTPStatusCode', 0)
+            return RetryHelper.getErrorCode(e) in RetryHelper.TRANSIENT_CODES or status >= 500
+        return False
+
+    @staticmethod
+    def backoff(attempt, reason, base=0.05, maxDelay=5):
+        # Sleeps a jittered exponential delay before retry number attempt
+        delay = random.uniform(0, min(maxDelay, base * (2 ** attempt)))
+        print("{}, retrying in {:.2f}s...".format(reason, delay))
+        time.sleep(delay)
+
+class QueueHelper:
+
+    @staticmethod
+    def put(results, stop, result):
+        # Bounded queue hand-off from a worker thread; gives up once the
+        # reader has gone away and set stop
+        while(not stop.is_set()):
+            try:
+                results.put(result, timeout=0.5)
+                return
+            except queue.Full:
+                pass
+
+class DynamoDBBatchWriter:
+    # Buffers put requests for one table and sends them as BatchWriteItem calls
+    # of up to 25 items, retrying UnprocessedItems with jittered exponential backoff.
+
+    def __init__(self, table, batchSize=25, maxRetries=8):
+        self._table = table
+        self._batchSize = batchSize
+        self._maxRetries = maxRetries
+        self._items = []
+
+    def putItem(self, item):
+        self._items.append(item)
+        if(len(self._items) >= self._batchSize):
+            self.flush()
+
+    def _writeBatch(self, requests):
+        client = self._table.meta.client
+        tableName = self._table.name
+
+        attempt = 0
+        while(requests):
+            response = client.batch_write_item(RequestItems={ tableName : requests })
+            requests = response.get('UnprocessedItems', {}).get(tableName, [])
+            if(requests):
+                attempt = attempt + 1
+                if(attempt > self._maxRetries):
+                    raise Exception("Failed to write {} items to {} after {} retries.".format(len(requests), tableName, self._maxRetries))
+                RetryHelper.backoff(attempt, "{} unprocessed items".format(len(requests)))
+
+    def flush(self):
+        while(self._items):
+            batch = self._items[:self._batchSize]
+            self._items = self._items[self._batchSize:]
+            self._writeBatch([{ 'PutRequest' : { 'Item' : item } } for item in batch])
+
 class AwsHelper:
-    def getClient(self, name, awsRegion=None):
-        config = Config(
-            retries = dict(
-                max_attempts = 30
-            )
+    # Clients are thread safe and shared by the whole process, so warm Lambda
+    # invocations and worker threads reuse them. Resources are not thread safe
+    # and are cached per thread. All use the same Config, so the cache is keyed
+    # by service and region. The default boto3 session is not thread safe
+    # either, so creation is serialized.
+    _lock = threading.Lock()
+    _config = Config(
+        retries = dict(
+            max_attempts = 30
         )
-        if(awsRegion):
-            return boto3.client(name, region_name=awsRegion, config=config)
-        else:
-            return boto3.client(name, config=config)
+    )
+    _clients = {}
+    _resources = threading.local()
+    _creationCounts = {}
 
-    def getResource(self, name, awsRegion=None):
-        config = Config(
-            retries = dict(
-                max_attempts = 30
-            )
-        )
+    @staticmethod
+    def _countCreation(kind, name):
+        key = "{}:{}".format(kind, name)
+        AwsHelper._creationCounts[key] = AwsHelper._creationCounts.get(key, 0) + 1
+
+    @staticmethod
+    def getCreationCounts():
+        with AwsHelper._lock:
+            return dict(AwsHelper._creationCounts)
+
+    def getClient(self, name, awsRegion=None, maxRetries=None):
+        # maxRetries overrides the retry count, e.g. so callers that pace
+        # their own requests see throttling errors instead of long retries
+        key = (name, awsRegion, maxRetries)
+        client = AwsHelper._clients.get(key)
+        if(client is None):
+            with AwsHelper._lock:
+                client = AwsHelper._clients.get(key)
+                if(client is None):
+                    config = AwsHelper._config
+                    if(maxRetries is not None):
+                        config = Config(retries = dict(max_attempts = maxRetries))
+                    client = boto3.client(name, region_name=awsRegion, config=config)
+                    AwsHelper._clients[key] = client
+                    AwsHelper._countCreation('client', name)
+        return client
 
-        if(awsRegion):
-            return boto3.resource(name, region_name=awsRegion, config=config)
+    def getResource(self, name, awsRegion=None):
+        resources = getattr(AwsHelper._resources, 'cache', None)
+        if(resources is None):
+            resources = {}
+            AwsHelper._resources.cache = resources
+
+        key = (name, awsRegion)
+        resource = resources.get(key)
+        if(resource is None):
+            with AwsHelper._lock:
+                resource = boto3.resource(name, region_name=awsRegion, config=AwsHelper._config)
+                AwsHelper._countCreation('resource', name)
+            resources[key] = resource
+        return resource
+
+class S3MultipartWriter:
+    # Streams str/bytes chunks to an S3 object. Content smaller than partSize
+    # is written with a single put_object on close. Anything larger becomes
+    # a multipart upload whose parts are uploaded in parallel, with at most
+    # maxConcurrency parts in flight. Memory use stays around
+    # (maxConcurrency + 1) * partSize no matter how large the object is.
+
+    MIN_PART_SIZE = 5 * 1024 * 1024
+
+    def __init__(self, bucketName, s3FileName, awsRegion=None, partSize=8 * 1024 * 1024, maxConcurrency=4):
+        self._bucketName = bucketName
+        self._s3FileName = s3FileName
+        self._partSize = max(partSize, S3MultipartWriter.MIN_PART_SIZE)
+        self._maxConcurrency = maxConcurrency
+        self._client = AwsHelper().getClient('s3', awsRegion)
+
+        self._buffer = bytearray()
+        self._uploadId = None
+        self._partNumber = 0
+        self._parts = []
+        self._inFlight = deque()
+        self._executor = None
+        self._bytesWritten = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, excType, excValue, traceback):
+        if(excType is None):
+            try:
+                self.close()
+            except Exception:
+                self.abort()
+                raise
         else:
-            return boto3.resource(name, config=config)
+            self.abort()
+        return False
+
+    @property
+    def bytesWritten(self):
+        return self._bytesWritten
+
+    def write(self, data):
+        if(isinstance(data, str)):
+            data = data.encode('utf-8')
+        self._buffer += data
+        self._bytesWritten += len(data)
+
+        while(len(self._buffer) >= self._partSize):
+            body = bytes(self._buffer[:self._partSize])
+            del self._buffer[:self._partSize]
+            self._uploadPart(body)
+
+    def getState(self):
+        # Waits for the parts in flight and returns (state, tail): the upload
+        # so far and the buffered bytes not yet uploaded. fromState continues
+        # the upload, e.g. in a later Lambda invocation.
+        while(self._inFlight):
+            self._completePart(self._inFlight.popleft())
+        state = {
+            'uploadId' : self._uploadId,
+            'partNumber' : self._partNumber,
+            'parts' : list(self._parts),
+            'bytesWritten' : self._bytesWritten
+        }
+        return state, bytes(self._buffer)
+
+    @staticmethod
+    def fromState(bucketName, s3FileName, state, tail, awsRegion=None, partSize=8 * 1024 * 1024, maxConcurrency=4):
+        writer = S3MultipartWriter(bucketName, s3FileName, awsRegion, partSize, maxConcurrency)
+        writer._uploadId = state['uploadId']
+        writer._partNumber = state['partNumber']
+        writer._parts = list(state['parts'])
+        writer._bytesWritten = state['bytesWritten']
+        writer._buffer = bytearray(tail)
+        if(writer._uploadId is not None):
+            writer._executor = ThreadPoolExecutor(max_workers=maxConcurrency)
+        return writer
+
+    def _uploadPart(self, body):
+        if(self._uploadId is None):
+            response = self._client.create_multipart_upload(Bucket=self._bucketName, Key=self._s3FileName)
+            self._uploadId = response['UploadId']
+            self._executor = ThreadPoolExecutor(max_workers=self._maxConcurrency)
+
+        # Back-pressure: wait for the oldest part before buffering another one
+        if(len(self._inFlight) >= self._maxConcurrency):
+            self._completePart(self._inFlight.popleft())
+
+        self._partNumber += 1
+        future = self._executor.submit(self._client.upload_part, Bucket=self._bucketName, Key=self._s3FileName,
+                                       PartNumber=self._partNumber, UploadId=self._uploadId, Body=body)
+        self._inFlight.append((self._partNumber, future))
+
+    def _completePart(self, inFlightPart):
+        partNumber, future = inFlightPart
+        response = future.result()
+        self._parts.append({ 'PartNumber' : partNumber, 'ETag' : response['ETag'] })
+
+    def close(self):
+        if(self._uploadId is None):
+            self._client.put_object(Bucket=self._bucketName, Key=self._s3FileName, Body=bytes(self._buffer))
+            self._buffer = bytearray()
+            return
+
+        try:
+            if(self._buffer):
+                body = bytes(self._buffer)
+                self._buffer = bytearray()
+                self._uploadPart(body)
+            while(self._inFlight):
+                self._completePart(self._inFlight.popleft())
+            self._client.complete_multipart_upload(Bucket=self._bucketName, Key=self._s3FileName,
+                                                   UploadId=self._uploadId,
+                                                   MultipartUpload={ 'Parts' : sorted(self._parts, key=lambda p: p['PartNumber']) })
+        finally:
+            self._executor.shutdown()
+
+    def detach(self):
+        # Releases the worker threads but leaves the upload open, to be continued through getState/fromState
+        if(self._executor):
+            self._executor.shutdown()
+            self._executor = None
+
+    def abort(self):
+        if(self._uploadId is not None):
+            self.detach()
+            self._client.abort_multipart_upload(Bucket=self._bucketName, Key=self._s3FileName, UploadId=self._uploadId)
+            self._uploadId = None
+        self._buffer = bytearray()
 
 class S3Helper:
     @staticmethod
     def getS3BucketRegion(bucketName):
-        client = boto3.client('s3')
+        client = AwsHelper().getClient('s3')
         response = client.get_bucket_location(Bucket=bucketName)
         awsRegion = response['LocationConstraint']
         return awsRegion
@@ -108,7 +369,7 @@ class S3Helper:
             else:
                 hasMoreContent = False
 
-            for doc in listObjectsResponse['Contents']:
+            for doc in listObjectsResponse.get('Contents', []):
                 docName = doc['Key']
                 docExt = FileHelper.getFileExtenstion(docName)
                 docExtLower = docExt.lower()
@@ -117,20 +378,104 @@ class S3Helper:
 
         return files
 
+    @staticmethod
+    def _listPrefixPage(s3client, bucketName, prefix, delimiter, allowedFileTypes, continuationToken):
+        if(continuationToken):
+            listObjectsResponse = s3client.list_objects_v2(
+                Bucket=bucketName,
+                Prefix=prefix,
+                Delimiter=delimiter,
+                ContinuationToken=continuationToken)
+        else:
+            listObjectsResponse = s3client.list_objects_v2(
+                Bucket=bucketName,
+                Prefix=prefix,
+                Delimiter=delimiter)
+
+        files = []
+        for doc in listObjectsResponse.get('Contents', []):
+            docName = doc['Key']
+            if(FileHelper.getFileExtenstion(docName).lower() in allowedFileTypes):
+                files.append(docName)
+
+        subPrefixes = [cp['Prefix'] for cp in listObjectsResponse.get('CommonPrefixes', [])]
+
+        nextToken = None
+        if(listObjectsResponse['IsTruncated']):
+            nextToken = listObjectsResponse['NextContinuationToken']
+
+        return prefix, files, subPrefixes, nextToken
+
+    @staticmethod
+    def iterFileNames(bucketName, prefix, allowedFileTypes, awsRegion=None, delimiter='/', maxWorkers=8):
+        # Yields matching keys while listing. Sub-prefixes discovered through
+        # the delimiter are listed in parallel on maxWorkers threads, and each
+        # listing page of a prefix is a separate task. Key order is not preserved.
+        s3client = AwsHelper().getClient('s3', awsRegion)
+
+        pendingPages = deque([(prefix, None)])
+        inFlight = set()
+
+        with ThreadPoolExecutor(max_workers=maxWorkers) as executor:
+            while(pendingPages or inFlight):
+                while(pendingPages and len(inFlight) < maxWorkers):
+                    pagePrefix, continuationToken = pendingPages.popleft()
+                    inFlight.add(executor.submit(S3Helper._listPrefixPage, s3client, bucketName, pagePrefix,
+                                                 delimiter, allowedFileTypes, continuationToken))
+
+                done, inFlight = wait(inFlight, return_when=FIRST_COMPLETED)
+                for future in done:
+                    pagePrefix, files, subPrefixes, nextToken = future.result()
+                    if(nextToken):
+                        pendingPages.appendleft((pagePrefix, nextToken))
+                    for subPrefix in subPrefixes:
+                        pendingPages.append((subPrefix, None))
+                    for docName in files:
+                        yield docName
+
     @staticmethod
     def writeToS3(content, bucketName, s3FileName, awsRegion=None):
-        s3 = AwsHelper().getResource('s3', awsRegion)
-        object = s3.Object(bucketName, s3FileName)
-        object.put(Body=content)
+        # Uses the shared client, which unlike a resource is safe to call from worker threads
+        s3client = AwsHelper().getClient('s3', awsRegion)
+        s3client.put_object(Bucket=bucketName, Key=s3FileName, Body=content)
+
+    @staticmethod
+    def writeStreamToS3(producer, bucketName, s3FileName, awsRegion=None, partSize=8 * 1024 * 1024, maxConcurrency=4):
+        # producer is an iterable of str/bytes chunks or a file-like object with read()
+        with S3MultipartWriter(bucketName, s3FileName, awsRegion, partSize, maxConcurrency) as writer:
+            if(hasattr(producer, 'read')):
+                chunk = producer.read(partSize)
+                while(chunk):
+                    writer.write(chunk)
+                    chunk = producer.read(partSize)
+            else:
+                for chunk in producer:
+                    writer.write(chunk)
+        return writer.bytesWritten
+
+    @staticmethod
+    def deleteFromS3(bucketName, s3FileName, awsRegion=None):
+        s3client = AwsHelper().getClient('s3', awsRegion)
+        s3client.delete_object(Bucket=bucketName, Key=s3FileName)
 
     @staticmethod
     def readFromS3(bucketName, s3FileName, awsRegion=None):
-        s3 = AwsHelper().getResource('s3', awsRegion)
-        obj = s3.Object(bucketName, s3FileName)
-        return obj.get()['Body'].read().decode('utf-8')
+        s3client = AwsHelper().getClient('s3', awsRegion)
+        response = s3client.get_object(Bucket=bucketName, Key=s3FileName)
+        return response['Body'].read().decode('utf-8')
 
     @staticmethod
-    def writeCSV(fieldNames, csvData, bucketName, s3FileName, awsRegion=None):
+    def writeJsonToS3(content, bucketName, s3FileName, awsRegion=None):
+        S3Helper.writeToS3(serializer.dumpsBytes(content), bucketName, s3FileName, awsRegion)
+
+    @staticmethod
+    def readJsonFromS3(bucketName, s3FileName, awsRegion=None):
+        s3client = AwsHelper().getClient('s3', awsRegion)
+        response = s3client.get_object(Bucket=bucketName, Key=s3FileName)
+        return serializer.loads(response['Body'].read())
+
+    @staticmethod
+    def getCSV(fieldNames, csvData):
         csv_file = io.StringIO()
         #with open(fileName, 'w') as csv_file:
         writer = csv.DictWriter(csv_file, fieldnames=fieldNames)
@@ -143,16 +488,124 @@ class S3Helper:
                 row[fieldNames[i]] = value
                 i = i + 1
             writer.writerow(row)
-        S3Helper.writeToS3(csv_file.getvalue(), bucketName, s3FileName)
+        return csv_file.getvalue()
 
     @staticmethod
-    def writeCSVRaw(csvData, bucketName, s3FileName):
+    def getCSVRaw(csvData):
         csv_file = io.StringIO()
         #with open(fileName, 'w') as csv_file:
         writer = csv.writer(csv_file)
         for item in csvData:
             writer.writerow(item)
-        S3Helper.writeToS3(csv_file.getvalue(), bucketName, s3FileName)
+        return csv_file.getvalue()
+
+    @staticmethod
+    def getObjectSize(bucketName, s3FileName, awsRegion=None):
+        s3client = AwsHelper().getClient('s3', awsRegion)
+        return s3client.head_object(Bucket=bucketName, Key=s3FileName)['ContentLength']
+
+    @staticmethod
+    def readRangeFromS3(bucketName, s3FileName, start, end, awsRegion=None):
+        # Returns bytes [start, end) of the object
+        s3client = AwsHelper().getClient('s3', awsRegion)
+        response = s3client.get_object(Bucket=bucketName, Key=s3FileName, Range="bytes={}-{}".format(start, end - 1))
+        return response['Body'].read()
+
+    @staticmethod
+    def readStreamFromS3(bucketName, s3FileName, awsRegion=None, chunkSize=1024 * 1024, rangeSize=8 * 1024 * 1024, maxConcurrency=4):
+        # Yields the object as bytes chunks. Objects larger than rangeSize are
+        # fetched as parallel range GETs, at most maxConcurrency ahead of the reader.
+        s3client = AwsHelper().getClient('s3', awsRegion)
+        size = S3Helper.getObjectSize(bucketName, s3FileName, awsRegion)
+
+        if(size <= rangeSize):
+            body = s3client.get_object(Bucket=bucketName, Key=s3FileName)['Body']
+            for chunk in body.iter_chunks(chunkSize):
+                yield chunk
+            return
+
+        with ThreadPoolExecutor(max_workers=maxConcurrency) as executor:
+            inFlight = deque()
+            for start in range(0, size, rangeSize):
+                if(len(inFlight) >= maxConcurrency):
+                    yield inFlight.popleft().result()
+                inFlight.append(executor.submit(S3Helper.readRangeFromS3, bucketName, s3FileName,
+                                                start, min(start + rangeSize, size), awsRegion))
+            while(inFlight):
+                yield inFlight.popleft().result()
+
+    @staticmethod
+    def readLinesFromS3(bucketName, s3FileName, awsRegion=None, **kwargs):
+        decoder = codecs.getincrementaldecoder('utf-8')()
+        remainder = ""
+        for chunk in S3Helper.readStreamFromS3(bucketName, s3FileName, awsRegion, **kwargs):
+            lines = (remainder + decoder.decode(chunk)).split('\n')
+            remainder = lines.pop()
+            for line in lines:
+                yield line
+        remainder = remainder + decoder.decode(b'', final=True)
+        if(remainder):
+            yield remainder
+
+    @staticmethod
+    def readJsonStreamFromS3(bucketName, s3FileName, awsRegion=None, **kwargs):
+        # Yields top level JSON values one at a time: the elements of a top
+        # level array (e.g. the response pages in response.json), or each value
+        # of a JSON lines / concatenated JSON object.
+        decoder = codecs.getincrementaldecoder('utf-8')()
+        jsonDecoder = json.JSONDecoder()
+        chunks = S3Helper.readStreamFromS3(bucketName, s3FileName, awsRegion, **kwargs)
+
+        buffer = ""
+        pos = 0
+        eof = False
+        inArray = None
+
+        while(True):
+            while(pos < len(buffer) and (buffer[pos].isspace() or (inArray and buffer[pos] == ','))):
+                pos += 1
+
+            if(pos < len(buffer)):
+                if(inArray is None):
+                    inArray = buffer[pos] == '['
+                    if(inArray):
+                        pos += 1
+                        continue
+                if(inArray and buffer[pos] == ']'):
+                    return
+                try:
+                    value, end = jsonDecoder.raw_decode(buffer, pos)
+                    # A top level number may continue in the next chunk ("1." decodes
+                    # as 1), so it is only complete once a delimiter follows or at EOF
+                    isNumber = isinstance(value, (int, float)) and not isinstance(value, bool)
+                    if(eof or (end < len(buffer) and (not isNumber or buffer[end].isspace() or buffer[end] in ',]'))):
+                        yield value
+                        buffer = buffer[end:]
+                        pos = 0
+                        continue
+                except ValueError:
+                    if(eof):
+                        raise
+
+            if(eof):
+                if(inArray):
+                    raise ValueError("Unterminated JSON array in s3://{}/{}".format(bucketName, s3FileName))
+                return
+
+            chunk = next(chunks, None)
+            if(chunk is None):
+                eof = True
+                buffer = buffer + decoder.decode(b'', final=True)
+            else:
+                buffer = buffer + decoder.decode(chunk)
+
+    @staticmethod
+    def writeCSV(fieldNames, csvData, bucketName, s3FileName, awsRegion=None):
+        S3Helper.writeToS3(S3Helper.getCSV(fieldNames, csvData), bucketName, s3FileName)
+
+    @staticmethod
+    def writeCSVRaw(csvData, bucketName, s3FileName):
+        S3Helper.writeToS3(S3Helper.getCSVRaw(csvData), bucketName, s3FileName)
 
 
 class FileHelper:
@@ -40,9 +40,12 @@ export class TextractPipelineStack extends cdk.Stack {
 
     //**********S3 Bucket******************************
     //S3 bucket for input documents and output
-    const contentBucket = new s3.Bucket(this, 'DocumentsBucket', { versioned: false});
+    //Uploads left open by checkpointed job result processing are cleaned up after a week
+    const contentBucket = new s3.Bucket(this, 'DocumentsBucket', { versioned: false,
+      lifecycleRules: [{ abortIncompleteMultipartUploadAfter: cdk.Duration.days(7) }]});
 
-    const existingContentBucket = new s3.Bucket(this, 'ExistingDocumentsBucket', { versioned: false});
+    const existingContentBucket = new s3.Bucket(this, 'ExistingDocumentsBucket', { versioned: false,
+      lifecycleRules: [{ abortIncompleteMultipartUploadAfter: cdk.Duration.days(7) }]});
     existingContentBucket.grantReadWrite(s3BatchOperationsRole)
 
     const inventoryAndLogsBucket = new s3.Bucket(this, 'InventoryAndLogsBucket', { versioned: false});
@@ -60,6 +63,22 @@ export class TextractPipelineStack extends cdk.Stack {
       partitionKey: { name: 'documentId', type: dynamodb.AttributeType.STRING },
       stream: dynamodb.StreamViewType.NEW_IMAGE
     });
+    //Index to query documents by status and creation time. statusShard is the status
+    //with a shard suffix (see DocumentStore.statusShard) so one status is not one hot partition
+    documentsTable.addGlobalSecondaryIndex({
+      indexName: 'DocumentStatusIndex',
+      partitionKey: { name: 'statusShard', type: dynamodb.AttributeType.STRING },
+      sortKey: { name: 'documentCreatedOn', type: dynamodb.AttributeType.STRING },
+      projectionType: dynamodb.ProjectionType.INCLUDE,
+      nonKeyAttributes: ['bucketName', 'objectName']
+    });
+
+    //DynamoDB table with state kept between invocations, e.g. the learned Textract submission rate.
+    //Every job start and completion updates the same counter item, so capacity is on demand
+    const controlTable = new dynamodb.Table(this, 'ControlTable', {
+      partitionKey: { name: 'controlId', type: dynamodb.AttributeType.STRING },
+      billingMode: dynamodb.BillingMode.PAY_PER_REQUEST
+    });
 
     //**********SQS Queues*****************************
     //DLQ
@@ -241,6 +260,9 @@ export class TextractPipelineStack extends cdk.Stack {
         ASYNC_QUEUE_URL: asyncJobsQueue.queueUrl,
         SNS_TOPIC_ARN : jobCompletionTopic.topicArn,
         SNS_ROLE_ARN : textractServiceRole.roleArn,
+        ASYNC_MAX_CONCURRENCY : "4",
+        ASYNC_MAX_JOBS : "100",
+        CONTROL_TABLE: controlTable.tableName,
         AWS_DATA_PATH : "models"
       }
     });
@@ -262,6 +284,7 @@ export class TextractPipelineStack extends cdk.Stack {
     contentBucket.grantRead(asyncProcessor)
     existingContentBucket.grantReadWrite(asyncProcessor)
     asyncJobsQueue.grantConsumeMessages(asyncProcessor)
+    controlTable.grantReadWriteData(asyncProcessor)
     asyncProcessor.addToRolePolicy(
       new iam.PolicyStatement({
         actions: ["iam:PassRole"],
@@ -287,6 +310,8 @@ export class TextractPipelineStack extends cdk.Stack {
       environment: {
         OUTPUT_TABLE: outputTable.tableName,
         DOCUMENTS_TABLE: documentsTable.tableName,
+        JOB_RESULTS_QUEUE_URL: jobResultsQueue.queueUrl,
+        PAGE_ARCHIVE: "false",
         AWS_DATA_PATH : "models"
       }
     });
@@ -300,6 +325,7 @@ export class TextractPipelineStack extends cdk.Stack {
     //Permissions
     outputTable.grantReadWriteData(jobResultProcessor)
     documentsTable.grantReadWriteData(jobResultProcessor)
+    jobResultsQueue.grantSendMessages(jobResultProcessor)
     contentBucket.grantReadWrite(jobResultProcessor)
     existingContentBucket.grantReadWrite(jobResultProcessor)
     jobResultProcessor.addToRolePolicy(